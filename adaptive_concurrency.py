@@ -0,0 +1,43 @@
+import math
+import os
+import threading
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+
+# Gradient-style concurrency limit: compare a short-term latency average with a
+# long-term one and shrink the limit when latency rises, grow it when it holds.
+# Failures (after the rate limiter's own retries) halve the limit.
+class AdaptiveConcurrency:
+    def __init__(self, max_limit=LLM_MAX_CONCURRENCY, min_limit=1, initial_limit=4):
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        self.limit = float(min(max(initial_limit, min_limit), self.max_limit))
+        self.in_flight = 0
+        self.short_latency = None
+        self.long_latency = None
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok=True):
+        with self._cond:
+            self.in_flight -= 1
+            if not ok:
+                self.limit = max(self.min_limit, self.limit / 2)
+            else:
+                self._update(latency)
+            self._cond.notify_all()
+
+    def _update(self, latency):
+        if self.long_latency is None:
+            self.short_latency = self.long_latency = latency
+        self.short_latency = 0.3 * latency + 0.7 * self.short_latency
+        self.long_latency = 0.05 * latency + 0.95 * self.long_latency
+        gradient = max(0.5, min(1.0, self.long_latency / max(self.short_latency, 1e-6)))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = min(self.max_limit, max(self.min_limit, 0.8 * self.limit + 0.2 * target))
@@ -0,0 +1,608 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_BASELINE_PATH = "bench_baseline.json"
+BENCH_OUTPUT_PATH = "bench_output.txt"
+# A stage regresses when its p95 grows or its throughput drops by more than this
+BENCH_REGRESSION_THRESHOLD = 0.2
+
+MOCK_LIMIT_REQUESTS = 10_000
+MOCK_LIMIT_TOKENS = 10_000_000
+
+CANNED_RECEIPT = {
+    "provider": "Amazon",
+    "invoice_number": "INV-0455",
+    "invoice_date": "2024-03-15",
+    "billing_period": "Mar 2024",
+    "invoice_account_id": "320567679581",
+    "payment_method": "Visa **** 1234",
+    "amount": "$136.42",
+    "tax_amount": "$10.00",
+    "total_amount": "$146.42",
+    "line_items": [
+        {"description": f"Meta Llama 3.1 {size} via Amazon Bedrock", "quantity": "8888", "rate": "0.00000003", "amount": f"${amount:.2f}"}
+        for size, amount in (("8B", 12.5), ("70B", 88.0), ("405B", 35.92))
+    ]
+    + [{"description": "S3 storage", "quantity": "1", "rate": "10.00", "amount": "$10.00"}],
+}
+
+SAMPLE_ITEMS = [
+    ("Meta Llama 3.1 8B Instruct - input tokens", 0.0000002),
+    ("Meta Llama 3.1 70B Instruct - output tokens", 0.0000009),
+    ("Llama Guard 3 moderation requests", 0.0001),
+    ("GPU hours (A100 80GB)", 2.21),
+    ("Object storage (GB-month)", 0.023),
+    ("Support plan", 29.0),
+]
+
+
+# Stand-in for POST /v1/chat/completions: fixed latency with jitter, injected
+# 429s with retry-after-ms, rate-limit headers and SSE streaming, always
+# answering with the same canned JSON
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        mock = self.server.mock
+        if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if mock.should_fail():
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}},
+                {"retry-after-ms": str(mock.retry_after_ms)},
+            )
+            return
+        time.sleep(mock.next_latency())
+
+        content = json.dumps(mock.canned)
+        usage = {"prompt_tokens": 1000, "completion_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        model = request.get("model", "mock")
+        if request.get("stream"):
+            self._send_stream(model, content, usage, (request.get("stream_options") or {}).get("include_usage"))
+            return
+        self._send_json(
+            200,
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                ],
+                "usage": usage,
+            },
+        )
+
+    def _limit_headers(self):
+        return {
+            "x-ratelimit-limit-requests": str(MOCK_LIMIT_REQUESTS),
+            "x-ratelimit-remaining-requests": str(MOCK_LIMIT_REQUESTS - 1),
+            "x-ratelimit-limit-tokens": str(MOCK_LIMIT_TOKENS),
+            "x-ratelimit-remaining-tokens": str(MOCK_LIMIT_TOKENS - 2000),
+        }
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in {**self._limit_headers(), **(headers or {})}.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, model, content, usage, include_usage):
+        self.send_response(200)
+        for name, value in self._limit_headers().items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices, **extra):
+            payload = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            data = f"data: {json.dumps(payload)}\n\n".encode()
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+        step = self.server.mock.stream_chunk_chars
+        try:
+            for start in range(0, len(content), step):
+                event([{"index": 0, "delta": {"content": content[start : start + step]}, "finish_reason": None}])
+            event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                event([], usage=usage)
+            done = b"data: [DONE]\n\n"
+            self.wfile.write(f"{len(done):X}\r\n".encode() + done + b"\r\n0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up once it had the whole object
+            self.close_connection = True
+
+
+class MockOpenAIServer:
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.2,
+        jitter=0.5,
+        error_rate=0.0,
+        retry_after_ms=20,
+        stream_chunk_chars=8,
+        canned=None,
+        seed=0,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_ms = retry_after_ms
+        self.stream_chunk_chars = stream_chunk_chars
+        self.canned = canned or CANNED_RECEIPT
+        self.requests = 0
+        self.rate_limited = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.error_rate
+            self.rate_limited += failed
+            return failed
+
+    def next_latency(self):
+        with self._lock:
+            return self.latency * (1 + self.jitter * (self._random.random() * 2 - 1))
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer((self.host, self.port), MockOpenAIHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# Synthetic corpus: text-layer PDFs of several lengths, "scanned" PDFs with no
+# text layer (rasterized, slightly rotated pages) and photo-sized images
+def invoice_lines(rng, page_num, items_per_page=25):
+    lines = [f"ACME Cloud Inc. - Invoice INV-{rng.randint(1000, 9999)} - page {page_num + 1}", ""]
+    for _ in range(items_per_page):
+        description, rate = rng.choice(SAMPLE_ITEMS)
+        quantity = rng.randint(1, 2_000_000)
+        lines.append(f"{description:<48} {quantity:>10} x {rate:<10} ${quantity * rate:>12,.2f}")
+    return lines
+
+
+def render_invoice_pdf(rng, pages):
+    import fitz
+
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_text((40, 50), "\n".join(invoice_lines(rng, page_num)), fontsize=8, fontname="cour")
+    return doc
+
+
+def build_corpus(directory, seed=0, text_pages=(1, 3, 10), scanned_pages=(1, 3), images=2):
+    import fitz
+    from PIL import Image
+
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    corpus = {"text_pdfs": [], "scanned_pdfs": [], "images": []}
+
+    for pages in text_pages:
+        path = os.path.join(directory, f"text_{pages}p.pdf")
+        with render_invoice_pdf(rng, pages) as doc:
+            doc.save(path)
+        corpus["text_pdfs"].append(path)
+
+    for pages in scanned_pages:
+        path = os.path.join(directory, f"scanned_{pages}p.pdf")
+        with render_invoice_pdf(rng, pages) as source, fitz.open() as scanned:
+            for page in source:
+                pix = page.get_pixmap(dpi=150)
+                image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+                image = image.rotate(rng.uniform(-1, 1), fillcolor="white", expand=False)
+                buffered = io.BytesIO()
+                image.save(buffered, format="JPEG", quality=70)
+                target = scanned.new_page(width=page.rect.width, height=page.rect.height)
+                target.insert_image(target.rect, stream=buffered.getvalue())
+            scanned.save(path)
+        corpus["scanned_pdfs"].append(path)
+
+    with render_invoice_pdf(rng, images) as doc:
+        for n, page in enumerate(doc):
+            # Phone-camera sized, like a typical receipt upload
+            pix = page.get_pixmap(dpi=300)
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            ext = "png" if n % 2 else "jpg"
+            path = os.path.join(directory, f"photo_{n}.{ext}")
+            image.save(path, format="PNG" if ext == "png" else "JPEG", quality=90)
+            corpus["images"].append(path)
+    return corpus
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank: the smallest sample with at least pct% of samples at or below it
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# Per-stage samples (seconds per operation) plus wall time and item counts
+# for throughput, so concurrent stages are not credited with summed latency
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.wall = defaultdict(float)
+        self.items = defaultdict(int)
+        self.units = {}
+        self.skipped = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage, items=1, unit="op"):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        self.samples[stage].append(elapsed)
+        self.wall[stage] += elapsed
+        self.items[stage] += items
+        self.units[stage] = unit
+
+    def record(self, stage, seconds):
+        self.samples[stage].append(seconds)
+
+    def add_wall(self, stage, seconds, items, unit="op"):
+        self.wall[stage] += seconds
+        self.items[stage] += items
+        self.units[stage] = unit
+
+    def skip(self, stage, reason):
+        self.skipped[stage] = reason
+
+    def summary(self):
+        result = {}
+        for stage, samples in self.samples.items():
+            ordered = sorted(samples)
+            wall = self.wall[stage]
+            result[stage] = {
+                "count": len(ordered),
+                "unit": self.units.get(stage, "op"),
+                "throughput": self.items[stage] / wall if wall else 0.0,
+                "p50": percentile(ordered, 50),
+                "p95": percentile(ordered, 95),
+                "p99": percentile(ordered, 99),
+            }
+        return result
+
+
+def quiet(enabled=True):
+    return contextlib.redirect_stdout(io.StringIO()) if enabled else contextlib.nullcontext()
+
+
+def bench_page_extraction(timer, corpus, repeat):
+    import fitz
+    from concurrent.futures import ProcessPoolExecutor
+    from invoice_parser import PAGE_WORKERS, extract_pdf_pages
+
+    with ProcessPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        for _ in range(repeat):
+            for path in corpus["text_pdfs"] + corpus["scanned_pdfs"]:
+                with fitz.open(path) as doc:
+                    pages = len(doc)
+                with timer.measure("page_extraction", pages, "page"):
+                    list(extract_pdf_pages(path, pool=pool))
+
+
+def bench_ocr(timer, corpus, repeat):
+    import pytesseract
+    from invoice_parser import PAGE_ROUTING_RULES, extract_page
+
+    try:
+        pytesseract.get_tesseract_version()
+    except Exception:
+        timer.skip("ocr", "tesseract is not installed")
+        return
+    rules = {**PAGE_ROUTING_RULES, "ocr_scanned_pages": True}
+    for _ in range(repeat):
+        for path in corpus["scanned_pdfs"]:
+            with timer.measure("ocr", 1, "page"):
+                extract_page(path, 0, rules)
+
+
+def bench_chunking(timer, repeat, pages=2000):
+    from invoice_parser import chunk_pages
+
+    rng = random.Random(1)
+    synthetic = [{"index": n, "tokens": rng.randint(50, 2500), "text": "", "image": None} for n in range(pages)]
+    for _ in range(repeat):
+        with timer.measure("chunking", pages, "page"):
+            list(chunk_pages(iter(synthetic)))
+
+
+def bench_image_prep(timer, corpus, repeat):
+    from llm_handler import page_count, prepare_image_data_urls
+
+    files = corpus["images"] + corpus["text_pdfs"] + corpus["scanned_pdfs"]
+    for _ in range(repeat):
+        for path in files:
+            with open(path, "rb") as f:
+                data = f.read()
+            name = os.path.basename(path)
+            pages = page_count(data, name)
+            with timer.measure("image_prep", pages, "page"):
+                prepare_image_data_urls(data, name, pages=range(pages))
+
+
+# Every upload of the corpus extracted at once, as the bot's workers would
+async def run_llm_fanout(timer, uploads):
+    from llm_clients import close_async_client
+    from llm_handler import extract_receipt_async
+
+    async def one(data, name):
+        start = time.perf_counter()
+        await extract_receipt_async(data, name)
+        timer.record("llm_fanout", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(data, name) for data, name in uploads))
+    finally:
+        await close_async_client()
+    timer.add_wall("llm_fanout", time.perf_counter() - start, len(uploads), "file")
+
+
+def bench_llm(timer, corpus, repeat, work_dir):
+    import invoice_parser
+    import llm_handler
+    from result_cache import ResultCache
+
+    uploads = []
+    for path in corpus["images"] + corpus["text_pdfs"] + corpus["scanned_pdfs"]:
+        with open(path, "rb") as f:
+            uploads.append((f.read(), os.path.basename(path)))
+
+    for n in range(repeat):
+        # A fresh cache each round so every request reaches the server
+        llm_handler.vision_cache = ResultCache(os.path.join(work_dir, f"vision_{n}"))
+        asyncio.run(run_llm_fanout(timer, uploads))
+
+        invoice_parser.configure_cache(os.path.join(work_dir, f"chunks_{n}"))
+        for path in corpus["text_pdfs"]:
+            with timer.measure("llm_chunks", 1, "file"):
+                invoice_parser.extract_invoice_details(path, force=True)
+
+
+def expense_row(rng, n):
+    items = [
+        {"description": description, "quantity": "1", "rate": str(rate), "amount": f"${rate * 1000:.2f}"}
+        for description, rate in rng.sample(SAMPLE_ITEMS, 3)
+    ]
+    line_items = json.dumps(items, separators=(",", ":"))
+    return (
+        str(rng.randint(1, 50)), f"user{n % 50}", "$100 for compute", "$100.00", "compute",
+        json.dumps(CANNED_RECEIPT, separators=(",", ":")), "✅ Match", f"bench_{n}.pdf",
+        "2024-03-15", f"INV-{n}", "320567679581", rng.choice(["Amazon", "Groq", "Together AI"]),
+        "Mar 2024", "Visa **** 1234", "$10.00", "$110.00", "$100.00", line_items, "{}",
+    ), items
+
+
+async def run_db_inserts(timer, rows):
+    import db
+
+    async def one(data, items):
+        start = time.perf_counter()
+        await db.insert_expense(data, items)
+        timer.record("db_insert", time.perf_counter() - start)
+
+    await db.init_db()
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(data, items) for data, items in rows))
+    finally:
+        await db.close_db()
+    timer.add_wall("db_insert", time.perf_counter() - start, len(rows), "row")
+
+
+def bench_db_and_export(timer, repeat, work_dir, rows=2000):
+    import db
+    import generate_expense_report as report
+
+    rng = random.Random(2)
+    for n in range(repeat):
+        db.DB_FILE = os.path.join(work_dir, f"bench_{n}.db")
+        asyncio.run(run_db_inserts(timer, [expense_row(rng, i) for i in range(rows)]))
+
+        report.DB_PATH = db.DB_FILE
+        report.REPORTS_DIR = os.path.join(work_dir, f"reports_{n}")
+        report.EXPORT_STATE_PATH = os.path.join(report.REPORTS_DIR, ".export_state.json")
+        with timer.measure("csv_export", rows, "row"):
+            report.export_report(fmt="csv")
+
+
+def compare(summary, baseline, threshold=BENCH_REGRESSION_THRESHOLD):
+    regressions = []
+    for stage, current in summary.items():
+        previous = baseline.get(stage)
+        if not previous:
+            continue
+        if previous["p95"] and current["p95"] > previous["p95"] * (1 + threshold):
+            regressions.append(f"{stage}: p95 {previous['p95'] * 1000:.1f}ms -> {current['p95'] * 1000:.1f}ms")
+        if previous["throughput"] and current["throughput"] < previous["throughput"] * (1 - threshold):
+            regressions.append(
+                f"{stage}: throughput {previous['throughput']:.1f} -> {current['throughput']:.1f} {current['unit']}/s"
+            )
+    return regressions
+
+
+def format_report(summary, skipped, baseline=None):
+    lines = [f"{'stage':<16}{'n':>5}{'throughput':>18}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'vs base p95':>13}"]
+    for stage, row in summary.items():
+        change = ""
+        if baseline and baseline.get(stage, {}).get("p95"):
+            change = f"{(row['p95'] / baseline[stage]['p95'] - 1) * 100:+.0f}%"
+        lines.append(
+            f"{stage:<16}{row['count']:>5}{row['throughput']:>12.1f} {row['unit'] + '/s':<5}"
+            f"{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}{row['p99'] * 1000:>10.1f}{change:>13}"
+        )
+    for stage, reason in skipped.items():
+        lines.append(f"{stage:<16}skipped: {reason}")
+    return "\n".join(lines)
+
+
+STAGES = ("page_extraction", "ocr", "chunking", "image_prep", "llm", "db_insert", "csv_export")
+
+
+def run_benchmarks(args):
+    work_dir = tempfile.mkdtemp(prefix="llama-bench-")
+    server = None
+    try:
+        if not args.base_url:
+            server = MockOpenAIServer(
+                latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed
+            ).start()
+        # Must be set before llm_handler / invoice_parser build their clients
+        os.environ["OPENAI_BASE_URL"] = args.base_url or server.base_url
+        os.environ.setdefault("OPENAI_API_KEY", "bench")
+        os.environ.setdefault("OPENAI_RPM", str(MOCK_LIMIT_REQUESTS))
+        os.environ.setdefault("OPENAI_TPM", str(MOCK_LIMIT_TOKENS))
+
+        corpus = build_corpus(args.corpus_dir or os.path.join(work_dir, "corpus"), seed=args.seed)
+        timer = StageTimer()
+        stages = set(args.stages or STAGES)
+        with quiet(not args.verbose):
+            if "page_extraction" in stages:
+                bench_page_extraction(timer, corpus, args.repeat)
+            if "ocr" in stages:
+                bench_ocr(timer, corpus, args.repeat)
+            if "chunking" in stages:
+                bench_chunking(timer, args.repeat)
+            if "image_prep" in stages:
+                bench_image_prep(timer, corpus, args.repeat)
+            if "llm" in stages:
+                bench_llm(timer, corpus, args.repeat, work_dir)
+            if {"db_insert", "csv_export"} & stages:
+                bench_db_and_export(timer, args.repeat, work_dir)
+        if server is not None:
+            print(f"Mock server: {server.requests} requests, {server.rate_limited} answered with 429")
+        return timer
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks against a local OpenAI stand-in")
+    commands = parser.add_subparsers(dest="command")
+
+    serve = commands.add_parser("serve", help="Only run the mock chat-completions server")
+    serve.add_argument("--port", type=int, default=8001)
+
+    for command in (parser, serve):
+        command.add_argument("--latency", type=float, default=0.2, help="Mock response latency in seconds")
+        command.add_argument("--jitter", type=float, default=0.5, help="Latency jitter as a fraction of --latency")
+        command.add_argument("--error-rate", type=float, default=0.05, help="Fraction of requests answered with 429")
+        command.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--repeat", type=int, default=3, help="Rounds per stage")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, help="Only run these stages")
+    parser.add_argument("--corpus-dir", help="Keep the generated corpus here")
+    parser.add_argument("--base-url", help="Use this server instead of starting the mock")
+    parser.add_argument("--baseline", default=BENCH_BASELINE_PATH, help="Baseline to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--threshold", type=float, default=BENCH_REGRESSION_THRESHOLD)
+    parser.add_argument("--output", default=BENCH_OUTPUT_PATH, help="Also write the report here")
+    parser.add_argument("--verbose", action="store_true", help="Show output from the code under test")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "serve":
+        server = MockOpenAIServer(
+            port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed
+        ).start()
+        print(f"Mock OpenAI server on {server.base_url} (set OPENAI_BASE_URL to use it)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.stop()
+        sys.exit(0)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from result_cache import atomic_write_json
+
+    timer = run_benchmarks(args)
+    summary = timer.summary()
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["stages"]
+    report = format_report(summary, timer.skipped, baseline)
+    print(report)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(report + "\n")
+
+    if args.save_baseline:
+        atomic_write_json(args.baseline, {"created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "stages": summary}, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif baseline is not None:
+        regressions = compare(summary, baseline, args.threshold)
+        if regressions:
+            print("Regressions against baseline:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("No regressions against baseline.")
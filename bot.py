@@ -1,20 +1,35 @@
+import asyncio
 import io
 import json
 import os
+import time
 from datetime import datetime
 
 import discord
-from db import init_db, insert_expense
+from db import (
+    claim_job,
+    close_db,
+    complete_job,
+    enqueue_job,
+    fail_job,
+    find_expenses_by_invoice,
+    init_db,
+    queue_stats,
+    requeue_running_jobs,
+)
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
 
+from llm_clients import close_async_client
 from llm_handler import (
     extract_llm_amount_and_items,
-    extract_text_from_combined_input,
-    parse_receipt_with_vision,
-    prepare_image_data_url,
+    extract_receipts_async,
+    extract_text_from_combined_input_async,
+    receipt_amount_problem,
 )
+from metrics import Scope, dump_metrics_from_env, metrics, start_metrics_from_env, track
+from money import amounts_match, parse_amount
 
 # Load environment variables
 load_dotenv()
@@ -22,6 +37,17 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 DISCORD_SERVER_ID = os.getenv("DISCORD_SERVER_ID")
 GUILD_ID = discord.Object(id=int(DISCORD_SERVER_ID))
 
+# Extractions allowed at once, across queue workers and speculative work
+SUBMISSION_WORKERS = int(os.getenv("SUBMISSION_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = 5
+# Discord rate-limits edits, so streamed line items are batched into updates
+LINE_ITEM_UPDATE_INTERVAL = 1.5
+DISCORD_MESSAGE_LIMIT = 2000
+
+COMPACT_JSON = (",", ":")
+MONTHLY_LIMIT = 6000
+
 # Ensure uploads directory exists
 os.makedirs("uploads", exist_ok=True)
 
@@ -32,16 +58,140 @@ class MyBot(commands.Bot):
         intents.message_content = True
         intents.dm_messages = True
         super().__init__(command_prefix="/", intents=intents)
+        self.job_available = asyncio.Event()
+        self.extraction_slots = asyncio.Semaphore(SUBMISSION_WORKERS)
+        self.speculative_extractions = {}
+        self.submission_metrics = {}
+        self.workers = []
 
     async def setup_hook(self):
         self.tree.copy_global_to(guild=GUILD_ID)
         await self.tree.sync(guild=GUILD_ID)
         await init_db()
+        start_metrics_from_env()
+        requeued = await requeue_running_jobs()
+        if requeued:
+            print(f"♻️ Resuming {requeued} interrupted submission(s)")
+        self.workers = [
+            asyncio.create_task(submission_worker()) for _ in range(SUBMISSION_WORKERS)
+        ]
+
+    async def close(self):
+        # Jobs cut off here stay 'running' and are requeued on the next start
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        await close_async_client()
+        await close_db()
+        dump_metrics_from_env()
+        await super().close()
 
 
 bot = MyBot()
 
 
+def save_upload(save_path, file_bytes):
+    with metrics.time("save"):
+        with open(save_path, "wb") as f:
+            f.write(file_bytes)
+
+
+def read_upload(save_path):
+    with open(save_path, "rb") as f:
+        return f.read()
+
+
+async def notify(user, message, **kwargs):
+    try:
+        await user.send(message, **kwargs)
+    except discord.HTTPException as e:
+        print(f"[Bot Error] Could not DM {user}: {e}")
+
+
+# JSON in a code block, or as an attached file when that would not fit in one
+# message (long invoices easily pass Discord's limit)
+async def notify_json(user, title, data, file_name):
+    text = json.dumps(data, indent=2)
+    message = f"{title}:\n```json\n{text}\n```"
+    if len(message) <= DISCORD_MESSAGE_LIMIT:
+        await notify(user, message)
+        return
+    attachment = discord.File(io.BytesIO(text.encode()), filename=file_name)
+    await notify(user, f"{title} (attached, too long for a message)", file=attachment)
+
+
+# One DM listing line items as the extraction decodes them, edited in place
+class LineItemProgress:
+    def __init__(self):
+        self.items = []
+        self.user = None
+        self.title = ""
+        self.message = None
+        self._changed = asyncio.Event()
+        self._closed = asyncio.Event()
+        self._task = None
+
+    def add(self, item):
+        self.items.append(item)
+        self._changed.set()
+
+    def attach(self, user, title):
+        self.user = user
+        self.title = title
+        self._changed.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._closed.set()
+            self._changed.set()
+            await self._task
+
+    def render(self):
+        header = f"🧾 {self.title}: {len(self.items)} line item(s) so far"
+        lines = [
+            f"• {str(item.get('description', ''))[:80]} — {item.get('amount', '')}"
+            for item in self.items
+        ]
+        # Keep the newest items when the list outgrows one message
+        shown, size = [], len(header) + 4
+        for line in reversed(lines):
+            size += len(line) + 1
+            if size > DISCORD_MESSAGE_LIMIT:
+                break
+            shown.append(line)
+        more = ["…"] if len(shown) < len(lines) else []
+        return "\n".join([header, *more, *reversed(shown)])
+
+    async def _run(self):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            await self._send()
+            if self._closed.is_set():
+                return
+            try:
+                await asyncio.wait_for(self._closed.wait(), LINE_ITEM_UPDATE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self):
+        if not self.items:
+            return
+        try:
+            if self.message is None:
+                self.message = await self.user.send(self.render())
+            else:
+                await self.message.edit(content=self.render())
+        except discord.HTTPException as e:
+            print(f"[Bot Error] Could not update line items for {self.user}: {e}")
+
+
+async def speculative_extract(uploads, progress):
+    async with bot.extraction_slots:
+        return await extract_receipts_async(uploads, on_item=progress.add)
+
+
 @bot.event
 async def on_ready():
     print(f"✅ Bot is online as {bot.user}")
@@ -56,169 +206,346 @@ async def submit_expense(interaction: discord.Interaction):
         "📩 Please check your DMs to upload your receipt!", ephemeral=True
     )
 
-    try:
-        dm = await interaction.user.create_dm()
-        await dm.send(
-            "👋 Hi! Please upload your **receipt file** (image or PDF). You have 2 minutes."
-        )
-
-        def attachment_check(m):
-            return (
-                m.author == interaction.user
-                and isinstance(m.channel, discord.DMChannel)
-                and m.attachments
+    upload_key = None
+    save_task = None
+    enqueued = False
+    # Everything recorded while collecting the upload, speculative extraction
+    # included, is reported with the submission once its job finishes
+    scope = Scope()
+    with track(scope):
+        try:
+            dm = await interaction.user.create_dm()
+            await dm.send(
+                "👋 Hi! Please upload your **receipt** (images or PDFs; attach every page in one message). You have 2 minutes."
             )
 
-        receipt_msg = await bot.wait_for("message", check=attachment_check, timeout=120)
-        attachment = receipt_msg.attachments[0]
-        file_bytes = await attachment.read()
-        file_name = attachment.filename
-
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        safe_filename = f"{interaction.user.id}_{timestamp}_{file_name}"
-        save_path = os.path.join("uploads", safe_filename)
-        with open(save_path, "wb") as f:
-            f.write(file_bytes)
-
-        data_url = prepare_image_data_url(file_bytes, file_name)
+            def attachment_check(m):
+                return (
+                    m.author == interaction.user
+                    and isinstance(m.channel, discord.DMChannel)
+                    and m.attachments
+                )
 
-        await dm.send(
-            "💬 Please enter your **requested amount and purpose** in one line (e.g., `$136.42 for March compute`):"
-        )
+            receipt_msg = await bot.wait_for("message", check=attachment_check, timeout=120)
+            attachments = receipt_msg.attachments
+            with metrics.time("download"):
+                file_contents = await asyncio.gather(*(a.read() for a in attachments))
+
+            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+            files = []
+            for n, attachment in enumerate(attachments):
+                prefix = f"{interaction.user.id}_{timestamp}" + (f"_{n}" if n else "")
+                safe_filename = f"{prefix}_{attachment.filename}"
+                files.append(
+                    {
+                        "file_name": attachment.filename,
+                        "safe_filename": safe_filename,
+                        "save_path": os.path.join("uploads", safe_filename),
+                    }
+                )
+            uploads = [(data, f["file_name"]) for data, f in zip(file_contents, files)]
+            upload_key = files[0]["save_path"]
+
+            # Save, rasterize and extract while the user is still typing the
+            # amount; the vision result does not depend on it, and the amount is
+            # reconciled against the extracted totals afterwards. Speculation only
+            # runs when an extraction slot is free, so it never adds to a backlog.
+            save_task = asyncio.gather(
+                *(
+                    asyncio.to_thread(save_upload, f["save_path"], data)
+                    for data, f in zip(file_contents, files)
+                )
+            )
+            if not bot.extraction_slots.locked():
+                progress = LineItemProgress()
+                bot.speculative_extractions[upload_key] = (
+                    asyncio.create_task(speculative_extract(uploads, progress)),
+                    progress,
+                )
 
-        def message_check(m):
-            return m.author == interaction.user and isinstance(
-                m.channel, discord.DMChannel
+            await dm.send(
+                "💬 Please enter your **requested amount and purpose** in one line (e.g., `$136.42 for March compute`):"
             )
 
-        input_msg = await bot.wait_for("message", check=message_check, timeout=90)
+            def message_check(m):
+                return m.author == interaction.user and isinstance(
+                    m.channel, discord.DMChannel
+                )
 
-        combined_input = input_msg.content.strip()
+            input_msg = await bot.wait_for("message", check=message_check, timeout=90)
 
-        extracted_user_input = extract_text_from_combined_input(combined_input)
-        reimbursement_amount = (
-            extracted_user_input.get("amount", "").replace("$", "").strip()
-        )
-        reimbursement_reason = extracted_user_input.get("reason", "").strip()
+            combined_input = input_msg.content.strip()
 
-        try:
-            if float(reimbursement_amount) > 6000:
+            extracted_user_input = await extract_text_from_combined_input_async(
+                combined_input
+            )
+            reimbursement_amount = (
+                extracted_user_input.get("amount", "").replace("$", "").strip()
+            )
+            reimbursement_reason = extracted_user_input.get("reason", "").strip()
+
+            requested = parse_amount(reimbursement_amount)
+            if requested is None:
+                await dm.send("❌ Could not parse the amount. Please try again.")
+                return
+            if requested > MONTHLY_LIMIT:
                 await dm.send(
                     "🚫 The requested amount exceeds the $6000/month limit. Please revise and resubmit."
                 )
                 return
-        except ValueError:
-            await dm.send("❌ Could not parse the amount. Please try again.")
-            return
 
-        await dm.send("✅ Got it! ⏳ Processing your invoice, please wait a sec...")
+            await save_task
+            # Registered first: a polling worker can claim the job as soon as
+            # it is inserted
+            bot.submission_metrics[upload_key] = scope
+            job_id = await enqueue_job(
+                str(interaction.user.id),
+                str(interaction.user),
+                {
+                    "combined_input": combined_input,
+                    "amount": reimbursement_amount,
+                    "reason": reimbursement_reason,
+                    "amount_source": extracted_user_input.get("source", "llm"),
+                    "files": files,
+                },
+            )
+            enqueued = True
+            bot.job_available.set()
+
+            stats = await queue_stats()
+            print(f"[Queue] Job #{job_id} enqueued, {stats['queued']} queued, {stats['running']} running")
+            await dm.send(
+                f"✅ Got it! ⏳ Submission #{job_id} is queued "
+                f"({stats['queued']} waiting). I'll message you here as it progresses."
+            )
 
-        extracted_json = parse_receipt_with_vision(
-            reimbursement_amount, reimbursement_reason, data_url
-        )
+        except Exception as e:
+            await interaction.user.send(f"❌ Something went wrong: {e}")
+            print(f"[Bot Error] {e}")
+        finally:
+            # Drop speculative work if the user abandoned or the request was rejected
+            if not enqueued:
+                bot.submission_metrics.pop(upload_key, None)
+                speculative = bot.speculative_extractions.pop(upload_key, None)
+                if speculative is not None:
+                    speculative[0].cancel()
+                if save_task is not None:
+                    try:
+                        await save_task
+                    except Exception as e:
+                        print(f"[Bot Error] Could not save upload: {e}")
 
-        llm_items, llm_total_amount = extract_llm_amount_and_items(extracted_json)
-        extracted_json["line_items"] = llm_items
-        extracted_json["llm_total_amount"] = llm_total_amount
-
-        invoice_date = extracted_json.get("invoice_date", "")
-        invoice_number = extracted_json.get("invoice_number", "")
-        invoice_account_id = (
-            extracted_json.get("invoice_account_id")
-            or extracted_json.get("payer_account_id")
-            or extracted_json.get("account_id")
-            or ""
-        )
-        provider = extracted_json.get("provider", "")
-        billing_period = extracted_json.get("billing_period", "")
-        payment_method = extracted_json.get("payment_method", "")
-        tax_amount = extracted_json.get("tax_amount", "")
-        total_amount = extracted_json.get("total_amount", "")
-        line_items = json.dumps(llm_items)
-        extra_data_str = json.dumps(
-            {
-                k: v
-                for k, v in extracted_json.items()
-                if k
-                not in {
-                    "invoice_date",
-                    "invoice_number",
-                    "provider",
-                    "billing_period",
-                    "payment_method",
-                    "amount",
-                    "tax_amount",
-                    "total_amount",
-                    "line_items",
-                    "llm_total_amount",
-                }
-            }
-        )
 
-        try:
-            total_amount_val = float(llm_total_amount.replace("$", "").replace(",", ""))
-            user_amount_val = float(reimbursement_amount.replace(",", ""))
-            match_status = (
-                "✅ Match"
-                if abs(total_amount_val - user_amount_val) < 0.01
-                else "❗Mismatch"
-            )
-        except Exception:
-            match_status = "⚠️ Parsing failed"
-
-        details = {
-            "User Input": combined_input,
-            "Requested Amount": f"${reimbursement_amount}",
-            "Reason": reimbursement_reason,
-            "Match Status": match_status,
-            "Saved File Path": save_path,
-        }
-
-        parsed_data = extracted_json
-        parsed_data.pop("line_items", None)
-        await dm.send(
-            f"✅ Line Items:\n```json\n{json.dumps(llm_items, indent=2)}\n```"
-        )
-        await dm.send(
-            f"✅ Parsed Data:\n```json\n{json.dumps(parsed_data, indent=2)}\n```"
-        )
-        await dm.send(
-            f"✅ Submission Summary:\n```json\n{json.dumps(details, indent=2)}\n```"
-        )
+@bot.tree.command(
+    name="queue_status",
+    description="Show how many expense submissions are waiting to be processed.",
+)
+async def queue_status(interaction: discord.Interaction):
+    stats = await queue_stats()
+    await interaction.response.send_message(
+        f"📊 Queued: {stats['queued']} · Running: {stats['running']} · "
+        f"Oldest wait: {stats['oldest_wait_seconds']:.0f}s · "
+        f"Recent average wait: {stats['recent_wait_seconds']:.1f}s",
+        ephemeral=True,
+    )
 
-        await dm.send(f"🔍 Llama Amount Match Check: {match_status}")
 
-        await insert_expense(
-            (
-                str(interaction.user.id),
-                str(interaction.user),
-                combined_input,
-                f"${reimbursement_amount}",
-                reimbursement_reason,
-                json.dumps(extracted_json),
-                match_status,
-                safe_filename,
-                invoice_date,
-                invoice_number,
-                invoice_account_id,
-                provider,
-                billing_period,
-                payment_method,
-                tax_amount,
-                total_amount,
-                llm_total_amount,
-                line_items,
-                extra_data_str,
+# A worker survives anything one job or one poll can throw; a job it claimed
+# is failed (and retried) rather than left 'running' until the next restart
+async def submission_worker():
+    while True:
+        try:
+            bot.job_available.clear()
+            job = await claim_job()
+            if job is None:
+                try:
+                    await asyncio.wait_for(bot.job_available.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_job(job)
+        except Exception as e:
+            print(f"[Bot Error] Submission worker: {e}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+async def run_job(job):
+    user = None
+    try:
+        payload = job["payload"]
+        user_id = int(job["user_id"])
+        user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+        scope = bot.submission_metrics.pop(payload["files"][0]["save_path"], None) or Scope()
+        # Wall time is the job's; stage totals include work done before it started
+        scope.started = time.monotonic()
+        with track(scope):
+            await notify(user, f"🔄 Submission #{job['id']}: extracting invoice details...")
+            extracted_json = await extract_for_job(job, user)
+            await notify(user, f"🔄 Submission #{job['id']}: checking line items...")
+            await finish_submission(job, user, extracted_json)
+        print(f"[Metrics] Submission #{job['id']}: {scope.summary()}")
+    except Exception as e:
+        retry = job["attempts"] < JOB_MAX_ATTEMPTS
+        print(f"[Bot Error] Job #{job['id']} attempt {job['attempts']}: {e}")
+        await fail_job(job["id"], str(e), retry=retry)
+        if retry:
+            bot.job_available.set()
+        elif user is not None:
+            await notify(user, f"❌ Something went wrong with submission #{job['id']}: {e}")
+
+
+async def extract_for_job(job, user):
+    payload = job["payload"]
+    files = payload["files"]
+    title = f"Submission #{job['id']}"
+    speculative = bot.speculative_extractions.pop(files[0]["save_path"], None)
+    if speculative is not None:
+        task, progress = speculative
+        progress.attach(user, title)
+        try:
+            extracted = await task
+            # Read without the amount; a mismatch goes through routing again below
+            if receipt_amount_problem(extracted, payload["amount"]) is None:
+                return extracted
+        except Exception as e:
+            print(f"[Bot Error] Speculative extraction failed, retrying: {e}")
+        finally:
+            await progress.close()
+
+    file_contents = await asyncio.gather(
+        *(asyncio.to_thread(read_upload, f["save_path"]) for f in files)
+    )
+    uploads = [(data, f["file_name"]) for data, f in zip(file_contents, files)]
+    progress = LineItemProgress()
+    progress.attach(user, title)
+    try:
+        async with bot.extraction_slots:
+            return await extract_receipts_async(
+                uploads, payload["amount"], payload["reason"], on_item=progress.add
             )
-        )
+    finally:
+        await progress.close()
+
+
+async def finish_submission(job, user, extracted_json):
+    payload = job["payload"]
+    files = payload["files"]
+    combined_input = payload["combined_input"]
+    reimbursement_amount = payload["amount"]
+    reimbursement_reason = payload["reason"]
+
+    llm_items, llm_total_amount = extract_llm_amount_and_items(extracted_json)
+    extracted_json["line_items"] = llm_items
+    extracted_json["llm_total_amount"] = llm_total_amount
+
+    invoice_date = extracted_json.get("invoice_date", "")
+    invoice_number = extracted_json.get("invoice_number", "")
+    invoice_account_id = (
+        extracted_json.get("invoice_account_id")
+        or extracted_json.get("payer_account_id")
+        or extracted_json.get("account_id")
+        or ""
+    )
+    provider = extracted_json.get("provider", "")
+    billing_period = extracted_json.get("billing_period", "")
+    payment_method = extracted_json.get("payment_method", "")
+    tax_amount = extracted_json.get("tax_amount", "")
+    total_amount = extracted_json.get("total_amount", "")
+    # Stored compact so exports can copy the columns as-is
+    line_items = json.dumps(llm_items, separators=COMPACT_JSON)
+    extra_data_str = json.dumps(
+        {
+            k: v
+            for k, v in extracted_json.items()
+            if k
+            not in {
+                "invoice_date",
+                "invoice_number",
+                "provider",
+                "billing_period",
+                "payment_method",
+                "amount",
+                "tax_amount",
+                "total_amount",
+                "line_items",
+                "llm_total_amount",
+            }
+        },
+        separators=COMPACT_JSON,
+    )
 
-        await dm.send(
-            "🎉 Your receipt has been successfully processed and recorded. Thank you!"
+    # Compared to the cent in Decimal; a total in another currency never matches
+    matched = amounts_match(llm_total_amount, reimbursement_amount)
+    if matched is None:
+        match_status = "⚠️ Parsing failed"
+    else:
+        match_status = "✅ Match" if matched else "❗Mismatch"
+    # Pages past VISION_MAX_PAGES were never read, so the total is partial
+    pages_not_read = extracted_json.get("pages_not_read") or []
+    if pages_not_read:
+        match_status += " (partial invoice)"
+
+    details = {
+        "Submission": f"#{job['id']}",
+        "User Input": combined_input,
+        "Requested Amount": f"${reimbursement_amount}",
+        "Reason": reimbursement_reason,
+        "Amount Parsed By": payload.get("amount_source", "llm"),
+        "Match Status": match_status,
+        "Saved File Paths": [f["save_path"] for f in files],
+    }
+    if pages_not_read:
+        details["Pages Not Read"] = pages_not_read
+    previous = await find_expenses_by_invoice(invoice_number, provider)
+    if previous:
+        details["Previously Submitted"] = [
+            f"#{expense_id} on {created_at}" for expense_id, _, created_at in previous
+        ]
+
+    parsed_data = dict(extracted_json)
+    parsed_data.pop("line_items", None)
+    await notify_json(user, "✅ Line Items", llm_items, "line_items.json")
+    await notify_json(user, "✅ Parsed Data", parsed_data, "parsed_data.json")
+    await notify_json(user, "✅ Submission Summary", details, "submission_summary.json")
+
+    await notify(user, f"🔍 Llama Amount Match Check: {match_status}")
+    if pages_not_read:
+        await notify(
+            user,
+            "⚠️ Only part of your invoice was read, so the Llama total and match check "
+            "cover the pages that were:\n" + "\n".join(f"- {note}" for note in pages_not_read),
         )
 
-    except Exception as e:
-        await interaction.user.send(f"❌ Something went wrong: {e}")
-        print(f"[Bot Error] {e}")
+    await complete_job(
+        job["id"],
+        (
+            job["user_id"],
+            job["username"],
+            combined_input,
+            f"${reimbursement_amount}",
+            reimbursement_reason,
+            json.dumps(parsed_data, separators=COMPACT_JSON),
+            match_status,
+            ", ".join(f["safe_filename"] for f in files),
+            invoice_date,
+            invoice_number,
+            invoice_account_id,
+            provider,
+            billing_period,
+            payment_method,
+            tax_amount,
+            total_amount,
+            llm_total_amount,
+            line_items,
+            extra_data_str,
+        ),
+        llm_items,
+        extracted_json.get("currency"),
+    )
+
+    await notify(
+        user, "🎉 Your receipt has been successfully processed and recorded. Thank you!"
+    )
 
 
 bot.run(DISCORD_TOKEN)
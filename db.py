@@ -1,52 +1,444 @@
+import asyncio
+import json
+import os
+
 import aiosqlite
 
+from metrics import metrics
+from money import normalize_currency, parse_amount, parse_money
+
 DB_FILE = "expenses.db"
 
+# Inserts arriving within DB_GROUP_COMMIT_DELAY of each other share one commit
+DB_GROUP_COMMIT = os.getenv("DB_GROUP_COMMIT", "1") == "1"
+DB_GROUP_COMMIT_SIZE = int(os.getenv("DB_GROUP_COMMIT_SIZE", "64"))
+DB_GROUP_COMMIT_DELAY = float(os.getenv("DB_GROUP_COMMIT_DELAY", "0.005"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Kept as a constant so sqlite3's statement cache reuses the compiled statement
+INSERT_EXPENSE_SQL = """
+    INSERT INTO expenses (
+        user_id, username, user_input_raw, requested_amount, user_reason, extracted_json, match_status, file_name,
+        invoice_date, invoice_number, invoice_account_id, provider, billing_period,
+        payment_method, tax_amount, total_amount, llm_total_amount,
+        line_items, extra_data
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+INSERT_LINE_ITEM_SQL = """
+    INSERT INTO expense_line_items (expense_id, position, description, quantity, rate, amount, currency)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+_db = None
+_db_lock = asyncio.Lock()
+_writer = None
+
+
+# Runs queued units of work in shared transactions. Each unit gets its own
+# savepoint so a failing insert does not take the rest of the batch with it.
+class GroupCommitWriter:
+    def __init__(self, db, max_batch=DB_GROUP_COMMIT_SIZE, max_delay=DB_GROUP_COMMIT_DELAY):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def submit(self, work):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((work, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        if self.queue.empty() and self.max_delay:
+            await asyncio.sleep(self.max_delay)
+        while len(batch) < self.max_batch and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            batch = await self._collect()
+            stopping = None in batch
+            batch = [item for item in batch if item is not None]
+            if not batch:
+                continue
+            results = []
+            try:
+                await self.db.execute("BEGIN")
+                for work, future in batch:
+                    await self.db.execute("SAVEPOINT unit")
+                    try:
+                        result = await work(self.db)
+                    except Exception as e:
+                        await self.db.execute("ROLLBACK TO unit")
+                        results.append((future, None, e))
+                    else:
+                        results.append((future, result, None))
+                    await self.db.execute("RELEASE unit")
+                await self.db.execute("COMMIT")
+            except Exception as e:
+                if self.db.in_transaction:
+                    await self.db.execute("ROLLBACK")
+                results = [(future, None, e) for _, future in batch]
+            for future, result, error in results:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+    async def close(self):
+        # Queued work is still committed before the writer stops
+        await self.queue.put(None)
+        await self.task
+
+
+# One connection for the life of the process; transactions are explicit
+async def get_db():
+    global _db
+    async with _db_lock:
+        if _db is None:
+            db = await aiosqlite.connect(DB_FILE, isolation_level=None, cached_statements=256)
+            for pragma in PRAGMAS:
+                await db.execute(pragma)
+            _db = db
+    return _db
+
+
+async def run_write(work):
+    global _writer
+    db = await get_db()
+    if DB_GROUP_COMMIT:
+        if _writer is None:
+            _writer = GroupCommitWriter(db)
+        return await _writer.submit(work)
+    async with _db_lock:
+        await db.execute("BEGIN")
+        try:
+            result = await work(db)
+        except BaseException:
+            await db.execute("ROLLBACK")
+            raise
+        await db.execute("COMMIT")
+        return result
+
+
+async def close_db():
+    global _db, _writer
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+    if _db is not None:
+        await _db.close()
+        _db = None
+
+
+# Line items rebuilt from each expense's JSON with the same parser inserts use.
+# The invoice currency, when the model reported one, is kept in extra_data.
+async def _backfill_line_items(db):
+    async with await db.execute(
+        """
+        SELECT
+            id,
+            line_items,
+            CASE WHEN json_valid(extra_data) THEN json_extract(extra_data, '$.currency') END
+        FROM expenses
+        WHERE json_valid(line_items)
+        """
+    ) as cursor:
+        expenses = await cursor.fetchall()
+    for expense_id, line_items, currency in expenses:
+        items = json.loads(line_items)
+        if isinstance(items, list):
+            await db.executemany(INSERT_LINE_ITEM_SQL, line_item_rows(expense_id, items, currency))
+
+
+# Schema history. Each entry moves the database to the next PRAGMA
+# user_version; never edit a shipped migration, append a new one. A step is a
+# SQL statement or an async callable taking the connection.
+MIGRATIONS = [
+    # 1: original expenses table (kept as IF NOT EXISTS so pre-migration
+    # databases are adopted as-is)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            username TEXT,
+            user_input_raw TEXT,
+            requested_amount TEXT,
+            user_reason TEXT,
+            extracted_json TEXT,
+            match_status TEXT,
+            file_name TEXT,
+            invoice_date TEXT,
+            invoice_number TEXT,
+            invoice_account_id TEXT,
+            provider TEXT,
+            billing_period TEXT,
+            payment_method TEXT,
+            tax_amount TEXT,
+            total_amount TEXT,
+            llm_total_amount TEXT,
+            line_items TEXT,
+            extra_data TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ],
+    # 2: created_at as fixed-width 'YYYY-MM-DD HH:MM:SS' UTC so plain
+    # comparisons range-scan the index, plus lookup indexes
+    [
+        """
+        UPDATE expenses
+        SET created_at = strftime('%Y-%m-%d %H:%M:%S', created_at)
+        WHERE created_at IS NOT NULL
+          AND strftime('%Y-%m-%d %H:%M:%S', created_at) IS NOT NULL
+          AND created_at != strftime('%Y-%m-%d %H:%M:%S', created_at)
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_expenses_created_at ON expenses (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_id ON expenses (user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_expenses_provider ON expenses (provider, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_expenses_invoice_number ON expenses (invoice_number, provider)",
+    ],
+    # 3: line items as rows with numeric columns, backfilled from the JSON
+    # with the same parsing as new submissions
+    [
+        """
+        CREATE TABLE IF NOT EXISTS expense_line_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            expense_id INTEGER NOT NULL REFERENCES expenses (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            description TEXT,
+            quantity REAL,
+            rate REAL,
+            amount REAL,
+            currency TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_line_items_expense ON expense_line_items (expense_id, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_expenses_month ON expenses (substr(created_at, 1, 7))",
+        _backfill_line_items,
+    ],
+    # 4: durable queue of submissions waiting for extraction
+    [
+        """
+        CREATE TABLE IF NOT EXISTS submission_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            username TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            expense_id INTEGER REFERENCES expenses (id),
+            enqueued_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            started_at TEXT,
+            finished_at TEXT
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_submission_jobs_status ON submission_jobs (status, id)",
+    ],
+]
+
 
 async def init_db():
-    async with aiosqlite.connect(DB_FILE) as db:
-        await db.execute("DROP TABLE IF EXISTS expenses")
+    db = await get_db()
+    async with await db.execute("PRAGMA user_version") as cursor:
+        (version,) = await cursor.fetchone()
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                if callable(statement):
+                    await statement(db)
+                else:
+                    await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            await db.execute("ROLLBACK")
+            raise
+        await db.execute("COMMIT")
+        print(f"Database migrated to schema version {number}")
+
+
+def to_number(value):
+    amount = parse_amount(value)
+    return float(amount) if amount is not None else None
+
+
+# Bare amounts are in the invoice's currency; NULL when the amount does not parse
+def line_item_rows(expense_id, line_items, currency=None):
+    default_currency = normalize_currency(currency)
+    rows = []
+    for position, item in enumerate(line_items or []):
+        if not isinstance(item, dict):
+            continue
+        amount = parse_money(item.get("amount"), default_currency)
+        rows.append(
+            (
+                expense_id,
+                position,
+                item.get("description"),
+                to_number(item.get("quantity")),
+                to_number(item.get("rate")),
+                float(amount[0]) if amount else None,
+                amount[1] if amount else None,
+            )
+        )
+    return rows
+
+
+async def _insert_expense_rows(db, data, line_items, currency=None):
+    cursor = await db.execute(INSERT_EXPENSE_SQL, data)
+    expense_id = cursor.lastrowid
+    rows = line_item_rows(expense_id, line_items, currency)
+    if rows:
+        await db.executemany(INSERT_LINE_ITEM_SQL, rows)
+    return expense_id
+
+
+async def insert_expense(data, line_items=None, currency=None):
+    async def work(db):
+        return await _insert_expense_rows(db, data, line_items, currency)
+
+    with metrics.time("db_insert"):
+        return await run_write(work)
+
+
+async def find_expenses_by_invoice(invoice_number, provider=None):
+    if not invoice_number:
+        return []
+    db = await get_db()
+    if provider:
+        query = "SELECT id, user_id, created_at FROM expenses WHERE invoice_number = ? AND provider = ?"
+        params = (invoice_number, provider)
+    else:
+        query = "SELECT id, user_id, created_at FROM expenses WHERE invoice_number = ?"
+        params = (invoice_number,)
+    async with db.execute(query, params) as cursor:
+        return await cursor.fetchall()
+
+
+# Submission job queue. Statuses: queued -> running -> done | failed.
+JOB_COLUMNS = "id, user_id, username, status, payload, attempts, enqueued_at"
+
+
+async def enqueue_job(user_id, username, payload):
+    async def work(db):
+        cursor = await db.execute(
+            "INSERT INTO submission_jobs (user_id, username, payload) VALUES (?, ?, ?)",
+            (user_id, username, json.dumps(payload, separators=(",", ":"))),
+        )
+        return cursor.lastrowid
+
+    return await run_write(work)
+
+
+async def claim_job():
+    async def work(db):
+        async with db.execute(
+            f"""
+            UPDATE submission_jobs
+            SET status = 'running', started_at = CURRENT_TIMESTAMP, attempts = attempts + 1
+            WHERE id = (SELECT id FROM submission_jobs WHERE status = 'queued' ORDER BY id LIMIT 1)
+            RETURNING {JOB_COLUMNS}
+            """
+        ) as cursor:
+            row = await cursor.fetchone()
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS.split(", "), row))
+        job["payload"] = json.loads(job["payload"])
+        return job
+
+    return await run_write(work)
+
+
+# Insert the expense and close its job in one transaction, so a crash can
+# never record the expense twice
+async def complete_job(job_id, data, line_items=None, currency=None):
+    async def work(db):
+        expense_id = await _insert_expense_rows(db, data, line_items, currency)
         await db.execute(
             """
-            CREATE TABLE expenses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                username TEXT,
-                user_input_raw TEXT,
-                requested_amount TEXT,
-                user_reason TEXT,
-                extracted_json TEXT,
-                match_status TEXT,
-                file_name TEXT,
-                invoice_date TEXT,
-                invoice_number TEXT,
-                invoice_account_id TEXT,
-                provider TEXT,
-                billing_period TEXT,
-                payment_method TEXT,
-                tax_amount TEXT,
-                total_amount TEXT,
-                llm_total_amount TEXT,
-                line_items TEXT,
-                extra_data TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """
+            UPDATE submission_jobs
+            SET status = 'done', expense_id = ?, error = NULL, finished_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (expense_id, job_id),
         )
-        await db.commit()
+        return expense_id
 
+    with metrics.time("db_insert"):
+        return await run_write(work)
 
-async def insert_expense(data):
-    async with aiosqlite.connect(DB_FILE) as db:
+
+async def fail_job(job_id, error, retry=False):
+    async def work(db):
         await db.execute(
             """
-            INSERT INTO expenses (
-                user_id, username, user_input_raw, requested_amount, user_reason, extracted_json, match_status, file_name,
-                invoice_date, invoice_number, invoice_account_id, provider, billing_period,
-                payment_method, tax_amount, total_amount, llm_total_amount,
-                line_items, extra_data
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-            data,
+            UPDATE submission_jobs
+            SET status = ?, error = ?, finished_at = CASE WHEN ? THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE id = ?
+            """,
+            ("queued" if retry else "failed", error, retry, job_id),
         )
-        await db.commit()
+
+    await run_write(work)
+
+
+# Jobs that were running when the process died go back to the queue
+async def requeue_running_jobs():
+    async def work(db):
+        cursor = await db.execute(
+            "UPDATE submission_jobs SET status = 'queued' WHERE status = 'running'"
+        )
+        return cursor.rowcount
+
+    return await run_write(work)
+
+
+async def queue_stats():
+    db = await get_db()
+    async with db.execute(
+        """
+        SELECT
+            SUM(status = 'queued'),
+            SUM(status = 'running'),
+            MAX(CASE WHEN status = 'queued'
+                THEN (julianday('now') - julianday(enqueued_at)) * 86400 END)
+        FROM submission_jobs
+        WHERE status IN ('queued', 'running')
+        """
+    ) as cursor:
+        queued, running, oldest_wait = await cursor.fetchone()
+    async with db.execute(
+        """
+        SELECT AVG((julianday(started_at) - julianday(enqueued_at)) * 86400)
+        FROM (
+            SELECT started_at, enqueued_at FROM submission_jobs
+            WHERE status = 'done' ORDER BY id DESC LIMIT 100
+        )
+        """
+    ) as cursor:
+        (recent_wait,) = await cursor.fetchone()
+    return {
+        "queued": queued or 0,
+        "running": running or 0,
+        "oldest_wait_seconds": oldest_wait or 0.0,
+        "recent_wait_seconds": recent_wait or 0.0,
+    }
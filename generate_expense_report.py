@@ -1,66 +1,239 @@
+import argparse
 import csv
+import gzip
 import json
 import os
 import sqlite3
+import sys
 from datetime import datetime, timedelta
 
+from result_cache import atomic_write_json
+
 DB_PATH = "expenses.db"
 REPORTS_DIR = "reports"
+EXPORT_STATE_PATH = os.path.join(REPORTS_DIR, ".export_state.json")
+EXPORT_FORMATS = ("csv", "csv.gz", "parquet", "feather")
 
 
 def ensure_reports_dir():
     os.makedirs(REPORTS_DIR, exist_ok=True)
 
 
-def get_filtered_rows(conn, start_date=None, end_date=None):
-    cursor = conn.cursor()
-    if start_date and end_date:
-        query = """
-            SELECT * FROM expenses
-            WHERE DATE(created_at) BETWEEN DATE(?) AND DATE(?)
-        """
-        cursor.execute(query, (start_date, end_date))
-    elif start_date:
-        query = "SELECT * FROM expenses WHERE DATE(created_at) >= DATE(?)"
-        cursor.execute(query, (start_date,))
+EXPORT_BATCH_SIZE = 1000
+JSON_COLUMNS = {"extracted_json", "line_items", "extra_data"}
+
+
+def export_columns(conn):
+    return [(row[1], row[2].upper()) for row in conn.execute("PRAGMA table_info(expenses)")]
+
+
+# JSON columns are compacted by SQLite's json() so no row is re-parsed in Python
+def export_select_list(conn):
+    return ", ".join(
+        f"CASE WHEN json_valid({col}) THEN json({col}) ELSE {col} END AS {col}"
+        if col in JSON_COLUMNS
+        else col
+        for col, _ in export_columns(conn)
+    )
+
+
+# created_at is stored as 'YYYY-MM-DD HH:MM:SS', so the range is applied to
+# the raw column and can use idx_expenses_created_at
+def date_range_filter(start_date=None, end_date=None, column="created_at"):
+    clauses, params = [], []
+    if start_date:
+        clauses.append(f"{column} >= DATE(?)")
+        params.append(start_date)
+    if end_date:
+        clauses.append(f"{column} < DATE(?, '+1 day')")
+        params.append(end_date)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    return where, params
+
+
+def iter_filtered_rows(
+    conn, start_date=None, end_date=None, batch_size=EXPORT_BATCH_SIZE, after_id=None
+):
+    where, params = date_range_filter(start_date, end_date)
+    # Follow the index order when filtering so SQLite never sorts in a temp b-tree
+    order = "created_at, id" if where else "id"
+    if after_id is not None:
+        # Incremental runs walk the rowid past the last exported id
+        where = "WHERE id > ?" + (f" AND {where[len('WHERE '):]}" if where else "")
+        params = [after_id, *params]
+        order = "id"
+    cursor = conn.execute(
+        f"SELECT {export_select_list(conn)} FROM expenses {where} ORDER BY {order}", params
+    )
+    column_names = [desc[0] for desc in cursor.description]
+
+    def batches():
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+    return batches(), column_names
+
+
+def write_csv(path, column_names, batches, compress=False, append=False):
+    write_header = not (append and os.path.exists(path))
+    opener = gzip.open if compress else open
+    # Appending to a .gz adds a new gzip member, which readers treat as one stream
+    with opener(path, mode="at" if append else "wt", newline="", encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
+        if write_header:
+            writer.writerow(column_names)
+        last_id = None
+        for rows in batches:
+            writer.writerows(rows)
+            last_id = rows[-1][0]
+    return last_id
+
+
+ARROW_TYPES = {"INTEGER": "int64", "REAL": "float64"}
+
+
+# pyarrow is only imported for columnar exports; None when not installed
+def load_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:  # columnar formats fall back to gzip CSV
+        return None
+    return pa
+
+
+def write_arrow(path, columns, batches, fmt):
+    pa = load_pyarrow()
+    schema = pa.schema(
+        [(name, getattr(pa, ARROW_TYPES.get(col_type, "string"))()) for name, col_type in columns]
+    )
+    if fmt == "parquet":
+        writer = pa.parquet.ParquetWriter(path, schema, compression="zstd")
+        write_batch = writer.write_batch
     else:
-        query = "SELECT * FROM expenses"
-        cursor.execute(query)
-    return cursor.fetchall(), [desc[0] for desc in cursor.description]
+        writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression="zstd"))
+        write_batch = writer.write_batch
+    last_id = None
+    try:
+        for rows in batches:
+            write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(zip(*rows), schema)],
+                schema=schema,
+            ))
+            last_id = rows[-1][0]
+    finally:
+        writer.close()
+    return last_id
 
 
-def generate_csv_report(start_date=None, end_date=None):
+def load_export_state():
+    try:
+        with open(EXPORT_STATE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Full or incremental export. Incremental runs only read rows with an id above
+# the high-water mark saved for that format; CSV outputs are appended to one
+# rolling file, columnar outputs get one part file per run.
+def export_report(start_date=None, end_date=None, fmt="csv", incremental=False):
+    if fmt in {"parquet", "feather"} and load_pyarrow() is None:
+        print(f"⚠️ pyarrow is not installed, writing gzip CSV instead of {fmt}.")
+        fmt = "csv.gz"
+
     ensure_reports_dir()
     conn = sqlite3.connect(DB_PATH)
-    rows, column_names = get_filtered_rows(conn, start_date, end_date)
+    state = load_export_state()
+    after_id = state.get(fmt, {}).get("last_id", 0) if incremental else None
+    batches, column_names = iter_filtered_rows(conn, start_date, end_date, after_id=after_id)
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filter_suffix = f"{start_date}_to_{end_date}" if start_date and end_date else "full"
-    filename = f"expense_report_{filter_suffix}_{timestamp}.csv"
-    csv_path = os.path.join(REPORTS_DIR, filename)
+    if incremental:
+        suffix = "incremental" if fmt.startswith("csv") else f"incremental_{after_id + 1}_{timestamp}"
+    else:
+        filter_suffix = f"{start_date}_to_{end_date}" if start_date and end_date else "full"
+        suffix = f"{filter_suffix}_{timestamp}"
+    path = os.path.join(REPORTS_DIR, f"expense_report_{suffix}.{fmt}")
+
+    if fmt.startswith("csv"):
+        last_id = write_csv(path, column_names, batches, compress=fmt == "csv.gz", append=incremental)
+    else:
+        last_id = write_arrow(path, export_columns(conn), batches, fmt)
+    conn.close()
+
+    if incremental:
+        if last_id is None:
+            if not fmt.startswith("csv") and os.path.exists(path):
+                os.remove(path)
+            print("✅ No new expenses since the last export.")
+            return None
+        state[fmt] = {"last_id": last_id, "exported_at": timestamp}
+        atomic_write_json(EXPORT_STATE_PATH, state, indent=2)
+    print(f"✅ Report generated: {path}")
+    return path
+
+
+def generate_csv_report(start_date=None, end_date=None):
+    return export_report(start_date, end_date, fmt="csv")
+
+
+# Llama spend rolled up from expense_line_items, one row per currency within
+# each group; each grouping is backed by an index (idx_expenses_user_id,
+# idx_expenses_provider, idx_expenses_month)
+AGGREGATE_GROUPS = {
+    "user": ("e.user_id", "e.user_id, MAX(e.username) AS username"),
+    "provider": ("e.provider", "e.provider"),
+    "month": ("substr(e.created_at, 1, 7)", "substr(e.created_at, 1, 7) AS month"),
+}
+
+
+def aggregate_report(conn, group_by, start_date=None, end_date=None):
+    group_expr, key_columns = AGGREGATE_GROUPS[group_by]
+    where, params = date_range_filter(start_date, end_date, column="e.created_at")
+    cursor = conn.execute(
+        f"""
+        SELECT
+            {key_columns},
+            COUNT(DISTINCT e.id) AS expenses,
+            COUNT(li.id) AS line_items,
+            li.currency AS currency,
+            ROUND(COALESCE(SUM(li.amount), 0), 2) AS llama_spend
+        FROM expenses AS e
+        LEFT JOIN expense_line_items AS li ON li.expense_id = e.id
+        {where}
+        GROUP BY {group_expr}, li.currency
+        ORDER BY {group_expr}, li.currency
+        """,
+        params,
+    )
+    return cursor.fetchall(), [desc[0] for desc in cursor.description]
 
-    with open(csv_path, mode="w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_ALL)
-        writer.writerow(column_names)
-
-        for row in rows:
-            row = list(row)
-            for i, col in enumerate(column_names):
-                if col in {"extracted_json", "line_items", "extra_data"}:
-                    try:
-                        # Use compact JSON to avoid line breaks in CSV cells
-                        row[i] = json.dumps(json.loads(row[i]), separators=(",", ":"))
-                    except Exception:
-                        pass
-            writer.writerow(row)
 
+def print_aggregate_report(group_by, start_date=None, end_date=None):
+    conn = sqlite3.connect(DB_PATH)
+    rows, column_names = aggregate_report(conn, group_by, start_date, end_date)
     conn.close()
-    print(f"✅ CSV report generated: {csv_path}")
 
+    widths = [
+        max(len(str(name)), *(len(str(row[i])) for row in rows)) if rows else len(name)
+        for i, name in enumerate(column_names)
+    ]
+    print("  ".join(name.ljust(width) for name, width in zip(column_names, widths)))
+    for row in rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
 
-if __name__ == "__main__":
+
+def interactive_menu():
     print("📅 Expense Report Generator")
-    mode = input("Choose mode:\n1) Full export\n2) Last 30 days\n3) Custom range\n> ")
+    mode = input(
+        "Choose mode:\n1) Full export\n2) Last 30 days\n3) Custom range\n"
+        "4) Llama spend per user\n5) Llama spend per provider\n6) Llama spend per month\n> "
+    )
 
     if mode == "1":
         generate_csv_report()
@@ -72,5 +245,45 @@ if __name__ == "__main__":
         start = input("Enter start date (YYYY-MM-DD): ").strip()
         end = input("Enter end date (YYYY-MM-DD): ").strip()
         generate_csv_report(start_date=start, end_date=end)
+    elif mode in {"4", "5", "6"}:
+        print_aggregate_report({"4": "user", "5": "provider", "6": "month"}[mode])
     else:
         print("❌ Invalid option.")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Expense report generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_range(command):
+        command.add_argument("--start", help="Start date (YYYY-MM-DD)")
+        command.add_argument("--end", help="End date (YYYY-MM-DD), inclusive")
+        command.add_argument("--last-days", type=int, help="Only the last N days")
+
+    export = commands.add_parser("export", help="Export expenses to a file")
+    add_range(export)
+    export.add_argument("--format", choices=EXPORT_FORMATS, default="csv")
+    export.add_argument(
+        "--incremental", action="store_true", help="Only export rows added since the last incremental run"
+    )
+
+    aggregate = commands.add_parser("aggregate", help="Print Llama spend totals")
+    add_range(aggregate)
+    aggregate.add_argument("--by", choices=sorted(AGGREGATE_GROUPS), required=True)
+
+    args = parser.parse_args()
+    if args.last_days:
+        args.start = (datetime.now() - timedelta(days=args.last_days)).strftime("%Y-%m-%d")
+        args.end = args.end or datetime.now().strftime("%Y-%m-%d")
+    return args
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        interactive_menu()
+    else:
+        args = parse_args()
+        if args.command == "export":
+            export_report(args.start, args.end, fmt=args.format, incremental=args.incremental)
+        else:
+            print_aggregate_report(args.by, args.start, args.end)
@@ -1,57 +1,256 @@
 import fitz  # PyMuPDF
-import pytesseract  # OCR fallback
-from openai import OpenAI
+import glob
 import json
+import threading
 import time
-from typing import List
+from collections import deque
+from typing import Iterable, Iterator, List
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from base64 import b64encode
 import io
-from PIL import Image
+import math
 import os
 import argparse
 
+try:
+    import tiktoken
+except ImportError:  # fall back to a character-based estimate
+    tiktoken = None
+
+from adaptive_concurrency import LLM_MAX_CONCURRENCY, AdaptiveConcurrency
+from json_stream import JSONStreamError
+from llm_clients import get_client
+from llm_handler import complete_json, fingerprint_file
+from metrics import dump_metrics_from_env, metrics, start_metrics_from_env
+from model_router import model_tiers, route
+from prompt_store import prompt_store
+from result_cache import CACHE_DIR, ResultCache, atomic_write_json, make_cache_key
+
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# Extract text and image per page
-def extract_pdf_pages(pdf_path: str) -> List[dict]:
-    doc = fitz.open(pdf_path)
-    pages = []
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        text = page.get_text()
-        if not text.strip():
-            print(f"OCR fallback used on page {page_num}")
-            pix = page.get_pixmap(dpi=300)
-            img_pil = Image.open(io.BytesIO(pix.tobytes("png")))
-            text = pytesseract.image_to_string(img_pil)
+# Used when process_chunk has no `routing:` entry in the prompts file
+CHUNK_MODEL = "gpt-4-turbo"
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", str(os.cpu_count() or 1)))
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "6000"))
+CHUNK_PACK_WINDOW = int(os.getenv("CHUNK_PACK_WINDOW", "32"))
+
+ROUTE_TEXT = "text"
+ROUTE_IMAGE = "image"
+ROUTE_IMAGE_OCR = "image+ocr"
+
+# Thresholds for deciding whether a page's text layer can stand in for its image
+PAGE_ROUTING_RULES = {
+    "text_min_chars": int(os.getenv("ROUTE_TEXT_MIN_CHARS", "100")),
+    "text_min_quality": float(os.getenv("ROUTE_TEXT_MIN_QUALITY", "0.9")),
+    "ocr_scanned_pages": os.getenv("ROUTE_OCR_SCANNED_PAGES", "0") == "1",
+}
+
+
+def write_log(message: str, log_file=None):
+    print(message)
+    if log_file:
+        with open(log_file, 'a') as lf:
+            lf.write(message + '\n')
+
+invoice_cache = ResultCache(os.path.join(CACHE_DIR, "invoices"))
+chunk_cache = ResultCache(os.path.join(CACHE_DIR, "chunks"))
+
+
+def configure_cache(cache_dir: str):
+    global invoice_cache, chunk_cache
+    invoice_cache = ResultCache(os.path.join(cache_dir, "invoices"))
+    chunk_cache = ResultCache(os.path.join(cache_dir, "chunks"))
+
+
+# Key a chunk by what is sent to the model, not by its position in the file
+def chunk_cache_key(chunk: List[dict]) -> str:
+    return make_cache_key(
+        "process_chunk",
+        prompt_store.current_version(),
+        ",".join(model_tiers("process_chunk", CHUNK_MODEL)),
+        prompt_store.get("process_chunk").text(),
+        *[p['text'] for p in chunk],
+        *[p['image'] for p in chunk if p['image']],
+    )
+
+# Each page worker process keeps the last document it opened
+_worker_doc = (None, None)
+
+
+def _open_worker_doc(pdf_path: str):
+    global _worker_doc
+    path, doc = _worker_doc
+    if path != pdf_path:
+        if doc is not None:
+            doc.close()
+        doc = fitz.open(pdf_path)
+        _worker_doc = (pdf_path, doc)
+    return doc
+
+
+_encoding = None
+
+
+def estimate_text_tokens(text: str) -> int:
+    global _encoding
+    if tiktoken is None:
+        return len(text) // 4 + 1
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(CHUNK_MODEL)
+        except KeyError:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+# High-detail image cost: fit in 2048x2048, short side to 768, then 170 tokens
+# per 512px tile plus a fixed 85
+def estimate_image_tokens(width: int, height: int) -> int:
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+# Share of characters that look like real text rather than broken glyph mappings
+def text_quality(text: str) -> float:
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    good = sum(1 for c in chars if c.isprintable() and c != "\ufffd" and not 0xE000 <= ord(c) <= 0xF8FF)
+    return good / len(chars)
+
+
+def route_page(text: str, rules: dict) -> tuple:
+    chars = len(text.strip())
+    if not chars:
+        route = ROUTE_IMAGE_OCR if rules["ocr_scanned_pages"] else ROUTE_IMAGE
+        return route, "no text layer"
+    quality = text_quality(text)
+    reason = f"{chars} chars, quality {quality:.2f}"
+    if chars >= rules["text_min_chars"] and quality >= rules["text_min_quality"]:
+        return ROUTE_TEXT, reason
+    return ROUTE_IMAGE_OCR, reason
+
+
+# Extract text and, when the text layer is not enough, image for a single page
+def extract_page(pdf_path: str, page_num: int, rules: dict = PAGE_ROUTING_RULES) -> dict:
+    timings = {}
+    start = time.perf_counter()
+    page = _open_worker_doc(pdf_path).load_page(page_num)
+    text = page.get_text()
+    route, reason = route_page(text, rules)
+    image = None
+    tokens = estimate_text_tokens(text)
+    timings["text_extract"] = time.perf_counter() - start
+    if route == ROUTE_IMAGE_OCR:
+        import pytesseract  # OCR fallback, only needed for scanned pages
+        from PIL import Image
+
+        start = time.perf_counter()
+        pix = page.get_pixmap(dpi=300)
+        img_pil = Image.open(io.BytesIO(pix.tobytes("png")))
+        try:
+            ocr_text = pytesseract.image_to_string(img_pil)
+        except Exception as e:
+            # Tesseract exceptions do not survive the trip back from the pool
+            ocr_text = ""
+            reason += f", OCR failed: {e}"
+        if len(ocr_text.strip()) > len(text.strip()):
+            text = ocr_text
+            tokens = estimate_text_tokens(text)
+        timings["ocr"] = time.perf_counter() - start
+    if route != ROUTE_TEXT:
+        start = time.perf_counter()
         pix = page.get_pixmap(dpi=150)
-        img_bytes = pix.tobytes("png")
-        img_base64 = b64encode(img_bytes).decode('utf-8')
-        pages.append({"text": text, "image": img_base64})
-    doc.close()
-    return pages
-
-# Chunk pages into manageable batches
-def chunk_pages(pages: List[dict], max_tokens=6000) -> List[List[dict]]:
-    chunks = []
-    current_chunk = []
-    current_length = 0
+        image = b64encode(pix.tobytes("png")).decode('utf-8')
+        tokens += estimate_image_tokens(pix.width, pix.height)
+        timings["rasterize"] = time.perf_counter() - start
+    return {
+        "index": page_num,
+        "text": text,
+        "image": image,
+        "tokens": tokens,
+        "route": route,
+        "route_reason": reason,
+        "timings": timings,
+    }
+
+
+# Extract pages across a process pool, yielding them in order as they finish.
+# At most `prefetch` pages are rendered ahead of the consumer.
+# Pass a shared `pool` to reuse worker processes across files.
+def extract_pdf_pages(
+    pdf_path: str,
+    workers: int = PAGE_WORKERS,
+    prefetch: int = None,
+    rules: dict = PAGE_ROUTING_RULES,
+    pool: ProcessPoolExecutor = None,
+) -> Iterator[dict]:
+    with fitz.open(pdf_path) as doc:
+        page_count = len(doc)
+    if not page_count:
+        return
+    prefetch = prefetch or workers * 2
+    own_pool = pool is None
+    if own_pool:
+        pool = ProcessPoolExecutor(max_workers=max(1, min(workers, page_count)))
+    try:
+        pending = deque()
+        next_page = 0
+        while next_page < page_count or pending:
+            while next_page < page_count and len(pending) < prefetch:
+                pending.append(pool.submit(extract_page, pdf_path, next_page, rules))
+                next_page += 1
+            yield pending.popleft().result()
+    finally:
+        if own_pool:
+            pool.shutdown(cancel_futures=True)
+        else:
+            for future in pending:
+                future.cancel()
+
+# Also records the page's stage timings; the worker processes cannot report them
+def log_page_routes(pages: Iterable[dict], log_file=None) -> Iterator[dict]:
     for page in pages:
-        page_length = len(page['text'])
-        if current_length + page_length > max_tokens:
-            chunks.append(current_chunk)
-            current_chunk = [page]
-            current_length = page_length
+        write_log(f"Page {page['index']+1} routed to {page['route']} ({page['route_reason']}).", log_file)
+        for stage, seconds in page.get("timings", {}).items():
+            metrics.observe(stage, seconds)
+        yield page
+
+# First-fit decreasing: big pages first, each into the first chunk with room.
+# Pages are put back in document order inside each chunk, and chunks are
+# ordered by their first page.
+def pack_pages(pages: List[dict], budget: int) -> List[List[dict]]:
+    bins = []
+    for page in sorted(pages, key=lambda p: p['tokens'], reverse=True):
+        for b in bins:
+            if b[0] >= page['tokens']:
+                b[0] -= page['tokens']
+                b[1].append(page)
+                break
         else:
-            current_chunk.append(page)
-            current_length += page_length
-    if current_chunk:
-        chunks.append(current_chunk)
-    return chunks
+            bins.append([budget - page['tokens'], [page]])
+    chunks = [sorted(b[1], key=lambda p: p['index']) for b in bins]
+    return sorted(chunks, key=lambda c: c[0]['index'])
+
+
+# Chunk pages into batches that fill the token budget. Packing happens over a
+# window of pages so chunks still stream out while later pages are extracted.
+def chunk_pages(
+    pages: Iterable[dict], max_tokens: int = CHUNK_TOKEN_BUDGET, window: int = CHUNK_PACK_WINDOW
+) -> Iterator[List[dict]]:
+    budget = max(1, max_tokens - estimate_text_tokens(prompt_store.get("process_chunk").text()))
+    pending = []
+    for page in pages:
+        pending.append(page)
+        if len(pending) >= window:
+            yield from pack_pages(pending, budget)
+            pending = []
+    if pending:
+        yield from pack_pages(pending, budget)
 
 # Worker to call GPT-4 on a single chunk
 def process_chunk(idx: int, chunk: List[dict], log_file=None, force=False):
@@ -59,155 +258,325 @@ def process_chunk(idx: int, chunk: List[dict], log_file=None, force=False):
         start_time = time.time()
         text = "\n\n".join([p['text'] for p in chunk])
 
-        response_path = f'chunk_{idx+1}_raw_response.json'
-        if os.path.exists(response_path) and not force:
-            with open(response_path, 'r') as f:
-                content = f.read()
-        else:
-            response = client.chat.completions.create(
-                model="gpt-4-turbo",
-                messages=[
-                    {"role": "system", "content": (
-                        "You are an expert invoice parser. Extract structured billing and usage information from the following invoice text.\n"
-                        "Return the data strictly in JSON format. Include all the following fields when available:\n"
-                        "- invoice_number\n"
-                        "- invoice_date\n"
-                        "- due_date\n"
-                        "- billing_period_start\n"
-                        "- billing_period_end\n"
-                        "- account_id\n"
-                        "- team_id\n"
-                        "- customer_id / user_id\n"
-                        "- payer_name / payer_email\n"
-                        "- vendor_name / service_provider\n"
-                        "- company or org name (e.g. OpenAI, Groq, Together AI, X.AI, Fireworks AI, Google Cloud, etc.)\n"
-                        "- address of payer or provider\n"
-                        "- currency\n"
-                        "- payment_method\n"
-                        "- region\n"
-                        "- service_name\n"
-                        "- category / department / environment (e.g. dev, staging, production)\n"
-                        "- resource_type (e.g. EC2, API, LLM)\n"
-                        "- model or instance_type (e.g. g5.12xlarge, Llama3-70B)\n"
-                        "- model_provider\n"
-                        "- description\n"
-                        "- usage_unit\n"
-                        "- usage_quantity / units_used\n"
-                        "- duration (e.g. hourly, monthly)\n"
-                        "- start_time\n"
-                        "- end_time\n"
-                        "- price_per_unit / price_per_token / price_per_request\n"
-                        "- number_of_tokens / number_of_requests\n"
-                        "- base_amount\n"
-                        "- line_total_amount\n"
-                        "- subtotal\n"
-                        "- discount / discount_percent\n"
-                        "- tax / tax_percent\n"
-                        "- adjustments / credits\n"
-                        "- total\n"
-                        "- amount_due\n"
-                        "- payment_status\n"
-                        "- link_to_pay / pay_online_url\n"
-                        "Only include values that are explicitly stated. Do not include any items with a $0 total\n"
-                        "unless they explicitly reference LLM usage, token counts, or named models like Llama.\n"
-                        "After extracting data, analyze it and extend the result with these fields. Think carefully\n"
-                        "and try to get a summary of expenses in the invoice that are related to Llama, LLM or inference\n"
-                        "- total_spent_on_llm or total_spent_on_inference\n"
-                        "- total_spent_on_llama\n"
-                        "- total_llama_tokens_used\n"
-                        "- total_llm_tokens_used\n"
-                        "- total_spent_by_provider (e.g. {'OpenAI': 12.50, 'Grok': 5.00})\n"
-                        "If the JSON output is malformed or partially invalid, attempt to fix it and return valid JSON."
-                        "Do not enclose in ```json```"
-                    )},
-                    {"role": "user", "content": [
-                        {"type": "text", "text": text},
-                        *[
-                            {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{p['image']}"}}
-                            for p in chunk
-                        ]
-                    ]}
-                ],
-                temperature=0.0,
-                max_tokens=1500,
-            )
-            content = response.choices[0].message.content.strip()
-            if content.strip() and content != "```json```":
-                with open(response_path, 'w') as f:
-                    f.write(content)
-            else:
-                print(f"Empty or markdown-only content on chunk {idx+1}, retrying once...")
-                time.sleep(2)
-                return process_chunk(idx, chunk, log_file)
-
-        if not content:
-            print(f"Empty response on chunk {idx+1}.")
-            return None
-
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
+        cache_key = chunk_cache_key(chunk)
+        cached = None if force else chunk_cache.get(cache_key)
+        if cached is not None:
+            write_log(f"Chunk {idx+1} served from cache.", log_file)
+            return cached
 
+        messages = [
+            {"role": "system", "content": prompt_store.get("process_chunk").text()},
+            {"role": "user", "content": [
+                {"type": "text", "text": text},
+                *[
+                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{p['image']}"}}
+                    for p in chunk
+                    if p['image']
+                ]
+            ]}
+        ]
         try:
-            data = json.loads(content)
-            duration = time.time() - start_time
-            log_msg = f"Chunk {idx+1} processed successfully in {duration:.2f} seconds."
-            print(log_msg)
-            if log_file:
-                with open(log_file, 'a') as lf:
-                    lf.write(log_msg + '\n')
-            return data
-        except json.JSONDecodeError as e:
-            print(f"JSON decoding failed on chunk {idx+1}: {str(e)}")
-            print("Raw response content:")
-            print(content)
+            data = route(
+                "process_chunk",
+                CHUNK_MODEL,
+                lambda model: complete_json(
+                    get_client().chat.completions.with_raw_response.create,
+                    messages,
+                    1500,
+                    model=model,
+                    temperature=0.0,
+                ),
+            )
+        except JSONStreamError as e:
+            print(f"No usable JSON on chunk {idx+1}: {str(e)}")
             return None
 
+        chunk_cache.set(cache_key, data)
+        duration = time.time() - start_time
+        write_log(f"Chunk {idx+1} processed successfully in {duration:.2f} seconds.", log_file)
+        return data
+
     except Exception as e:
-        error_msg = str(e)
-        print(f"An error occurred on chunk {idx+1}: {error_msg}")
-        if 'rate_limit' in error_msg or '429' in error_msg:
-            print("Rate limit hit. Sleeping for 10 seconds and retrying...")
-            time.sleep(10)
-            return process_chunk(idx, chunk, log_file, force)
+        print(f"An error occurred on chunk {idx+1}: {str(e)}")
         return None
 
+def invoice_cache_key(pdf_path: str) -> str:
+    with open(pdf_path, 'rb') as f:
+        return make_cache_key(
+            fingerprint_file(f.read(), pdf_path),
+            "process_chunk",
+            prompt_store.current_version(),
+            ",".join(model_tiers("process_chunk", CHUNK_MODEL)),
+        )
+
+
+# Tracks one file's chunks through the scheduler and reports when all are done
+class InvoiceJob:
+    def __init__(self, pdf_path: str, cache_key: str, on_complete=None, log_file=None):
+        self.pdf_path = pdf_path
+        self.cache_key = cache_key
+        self.on_complete = on_complete
+        self.log_file = log_file
+        self.start_time = time.time()
+        self.results = {}
+        self.structured_data = None
+        self.complete = False
+        self.error = None
+        self._pending = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def add_chunk(self):
+        with self._lock:
+            self._pending += 1
+
+    def chunk_done(self, idx: int, result):
+        with self._lock:
+            self.results[idx] = result
+            self._pending -= 1
+            finished = self._closed and not self._pending
+        if finished:
+            self._finish()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            finished = not self._pending
+        if finished:
+            self._finish()
+
+    def wait(self):
+        self._done.wait()
+        return self.structured_data
+
+    def _finish(self):
+        results = self.results
+        self.structured_data = [results[idx] for idx in sorted(results) if results[idx] is not None]
+        self.complete = self.error is None and len(self.structured_data) == len(results)
+        if self.complete:
+            invoice_cache.set(self.cache_key, self.structured_data)
+        duration = time.time() - self.start_time
+        write_log(
+            f"{self.pdf_path}: {len(results)} chunks, {len(results) - len(self.structured_data)} failed, "
+            f"{duration:.2f} seconds.",
+            self.log_file,
+        )
+        try:
+            if self.on_complete:
+                self.on_complete(self)
+        except Exception as e:
+            print(f"Failed to finish {self.pdf_path}: {e}")
+        finally:
+            self._done.set()
+
+
+# One page pool, one LLM pool and one concurrency limit shared by every file
+class ChunkScheduler:
+    def __init__(self, max_workers: int = LLM_MAX_CONCURRENCY, force: bool = False, log_file=None):
+        self.force = force
+        self.log_file = log_file
+        self.concurrency = AdaptiveConcurrency(max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency.max_limit)
+        self.page_pool = ProcessPoolExecutor(max_workers=PAGE_WORKERS)
+
+    # Feed a file's chunks to the LLM workers while its later pages are still
+    # being extracted. Returns once every chunk has been submitted.
+    def schedule(self, job: InvoiceJob, max_tokens: int = CHUNK_TOKEN_BUDGET, pack_window: int = CHUNK_PACK_WINDOW):
+        try:
+            pages = log_page_routes(extract_pdf_pages(job.pdf_path, pool=self.page_pool), self.log_file)
+            for idx, chunk in enumerate(chunk_pages(pages, max_tokens, pack_window)):
+                self.concurrency.acquire()
+                job.add_chunk()
+                self.executor.submit(self._run_chunk, job, idx, chunk)
+        except Exception as e:
+            job.error = e
+            raise
+        finally:
+            job.close()
+
+    def _run_chunk(self, job: InvoiceJob, idx: int, chunk: List[dict]):
+        start_time = time.time()
+        result = None
+        try:
+            result = process_chunk(idx, chunk, self.log_file, self.force)
+        finally:
+            self.concurrency.release(time.time() - start_time, ok=result is not None)
+            job.chunk_done(idx, result)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.page_pool.shutdown(cancel_futures=True)
+
+
+def log_cache_stats(total_start_time: float, log_file=None):
+    total_duration = time.time() - total_start_time
+    stats = chunk_cache.stats()
+    final_log = (
+        f"\nTotal extraction time: {total_duration:.2f} seconds. "
+        f"Chunk cache: {stats['hits']} hits, {stats['misses']} misses, "
+        f"{stats['evictions']} evictions."
+    )
+    write_log(final_log, log_file)
+
+
 # Process all chunks in parallel
-def extract_invoice_details(pdf_path: str, force: bool = False, log_file: str = None):
+def extract_invoice_details(
+    pdf_path: str,
+    force: bool = False,
+    log_file: str = None,
+    max_tokens: int = CHUNK_TOKEN_BUDGET,
+    pack_window: int = CHUNK_PACK_WINDOW,
+    max_workers: int = LLM_MAX_CONCURRENCY,
+):
     total_start_time = time.time()
-    pages = extract_pdf_pages(pdf_path)
-    chunks = chunk_pages(pages)
-
-    structured_data = []
-    with ThreadPoolExecutor(max_workers=16) as executor:
-        futures = [executor.submit(process_chunk, idx, chunk, log_file, force) for idx, chunk in enumerate(chunks)]
-        results_with_index = [(future.result(), idx) for idx, future in enumerate(futures)]
-    results_with_index.sort(key=lambda x: x[1])
-    for result, _ in results_with_index:
-        if result is not None:
-            structured_data.append(result)
 
-    total_duration = time.time() - total_start_time
-    final_log = f"\nTotal extraction time: {total_duration:.2f} seconds."
-    print(final_log)
-    if log_file:
-        with open(log_file, 'a') as lf:
-            lf.write(final_log + '\n')
+    cache_key = invoice_cache_key(pdf_path)
+    if not force:
+        cached = invoice_cache.get(cache_key)
+        if cached is not None:
+            print(f"Cache hit for {pdf_path}, skipping extraction.")
+            return cached
 
+    scheduler = ChunkScheduler(max_workers, force, log_file)
+    try:
+        job = InvoiceJob(pdf_path, cache_key, log_file=log_file)
+        scheduler.schedule(job, max_tokens, pack_window)
+        structured_data = job.wait()
+    finally:
+        scheduler.shutdown()
+
+    log_cache_stats(total_start_time, log_file)
     return structured_data
 
+
+# Outputs mirror the input tree below the batch's common directory, so
+# bills/aws/invoice.pdf and bills/gcp/invoice.pdf get separate files
+def input_root(pdf_paths: List[str]) -> str:
+    if not pdf_paths:
+        return "."
+    return os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in pdf_paths])
+
+
+def output_path_for(pdf_path: str, output_dir: str, root: str) -> str:
+    relative = os.path.relpath(os.path.abspath(pdf_path), root)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + ".json")
+
+
+# Process many files through one scheduler. Each finished file is written to
+# <output_dir>/<path below the input root>.json; files that already have an
+# output are skipped, so an interrupted batch resumes where it stopped (and the
+# chunk cache covers files that were half done). Files with failed chunks get
+# <name>.partial.json and are retried on the next run. Returns the files that
+# were not extracted, including any whose output name collides with another's.
+def extract_invoices(
+    pdf_paths: List[str],
+    output_dir: str,
+    force: bool = False,
+    log_file: str = None,
+    max_tokens: int = CHUNK_TOKEN_BUDGET,
+    pack_window: int = CHUNK_PACK_WINDOW,
+    max_workers: int = LLM_MAX_CONCURRENCY,
+):
+    total_start_time = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+
+    pdf_paths = list(dict.fromkeys(pdf_paths))
+    root = input_root(pdf_paths)
+
+    def write_output(job: InvoiceJob):
+        path = output_path_for(job.pdf_path, output_dir, root)
+        partial_path = path[:-len(".json")] + ".partial.json"
+        if job.complete:
+            atomic_write_json(path, job.structured_data, indent=2)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        else:
+            atomic_write_json(partial_path, job.structured_data, indent=2)
+
+    seen_outputs = set()
+    collisions = []
+    jobs = []
+    scheduler = ChunkScheduler(max_workers, force, log_file)
+    try:
+        for pdf_path in pdf_paths:
+            output_path = output_path_for(pdf_path, output_dir, root)
+            if output_path in seen_outputs:
+                write_log(f"Not extracting {pdf_path}: another file already writes {output_path}.", log_file)
+                collisions.append(pdf_path)
+                continue
+            seen_outputs.add(output_path)
+            if os.path.exists(output_path) and not force:
+                print(f"Skipping {pdf_path}: already extracted.")
+                continue
+
+            job = InvoiceJob(pdf_path, invoice_cache_key(pdf_path), write_output, log_file)
+            cached = None if force else invoice_cache.get(job.cache_key)
+            if cached is not None:
+                job.structured_data, job.complete = cached, True
+                write_output(job)
+                print(f"Cache hit for {pdf_path}, skipping extraction.")
+                continue
+            jobs.append(job)
+            try:
+                scheduler.schedule(job, max_tokens, pack_window)
+            except Exception as e:
+                write_log(f"Failed to read {pdf_path}: {e}", log_file)
+        for job in jobs:
+            job.wait()
+    finally:
+        scheduler.shutdown()
+
+    log_cache_stats(total_start_time, log_file)
+    failed = [job.pdf_path for job in jobs if not job.complete]
+    write_log(
+        f"Batch done: {len(jobs) - len(failed)} files extracted, {len(failed)} incomplete, "
+        f"{len(collisions)} not extracted because of output name collisions.",
+        log_file,
+    )
+    return failed + collisions
+
+
 # Example usage
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('--pdf', type=str, required=True, help='Path to invoice PDF')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--pdf', type=str, help='Path to invoice PDF')
+    source.add_argument('--input-dir', type=str, help='Extract every PDF in this directory')
+    source.add_argument('--glob', type=str, help="Extract every file matching this pattern, e.g. 'bills/**/*.pdf'")
+    parser.add_argument('--output-dir', type=str, default='extracted', help='Where batch mode writes one JSON per file')
     parser.add_argument('--force', action='store_true', help='Force reprocessing all chunks')
     parser.add_argument('--log', type=str, default='processing.log', help='Path to log file')
+    parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Directory for cached chunk results')
+    parser.add_argument('--chunk-tokens', type=int, default=CHUNK_TOKEN_BUDGET, help='Token budget per chunk request')
+    parser.add_argument('--pack-window', type=int, default=CHUNK_PACK_WINDOW, help='Pages packed together at a time')
+    parser.add_argument('--max-workers', type=int, default=LLM_MAX_CONCURRENCY, help='Ceiling for concurrent LLM calls')
     args = parser.parse_args()
 
-    pdf_file = args.pdf
-    invoice_data = extract_invoice_details(pdf_file, force=args.force, log_file=args.log)
-    with open('extracted_invoice_data.json', 'w') as f:
-        json.dump(invoice_data, f, indent=2)
-    print("Invoice data extraction completed and saved.")
+    configure_cache(args.cache_dir)
+    start_metrics_from_env()
+
+    options = dict(
+        force=args.force,
+        log_file=args.log,
+        max_tokens=args.chunk_tokens,
+        pack_window=args.pack_window,
+        max_workers=args.max_workers,
+    )
+    if args.pdf:
+        invoice_data = extract_invoice_details(args.pdf, **options)
+        with open('extracted_invoice_data.json', 'w') as f:
+            json.dump(invoice_data, f, indent=2)
+        print("Invoice data extraction completed and saved.")
+    else:
+        if args.input_dir:
+            pdf_paths = sorted(glob.glob(os.path.join(args.input_dir, '*.pdf')))
+        else:
+            pdf_paths = sorted(glob.glob(args.glob, recursive=True))
+        failed = extract_invoices(pdf_paths, args.output_dir, **options)
+        print(f"Batch extraction completed, outputs in {args.output_dir}.")
+        if failed:
+            print("Files not extracted (re-run to retry incomplete ones):")
+            for path in failed:
+                print(f"  {path}")
+    dump_metrics_from_env()
@@ -0,0 +1,138 @@
+import json
+
+CLOSERS = {"{": "}", "[": "]"}
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        raise JSONStreamError(f"Invalid JSON: {e}") from e
+
+
+# Parses a single JSON object as a model streams it. Complete objects inside
+# the top-level `item_key` array are returned from feed() as soon as they close,
+# output that cannot be the expected object fails on the first bad character,
+# and a truncated stream can be closed off at the last complete value.
+class IncrementalJSONParser:
+    def __init__(self, item_key="line_items"):
+        self.item_key = item_key
+        self.text = ""
+        self.started = False
+        self.done = False
+        self._prefix = ""
+        self._stack = []  # (opening char, key it was opened under, start offset)
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string = None
+        self._after_colon = False
+        self._safe_end = 0
+        self._safe_closers = ""
+
+    def feed(self, chunk):
+        items = []
+        if self.done:
+            return items
+        if not self.started:
+            for i, char in enumerate(chunk):
+                if self._skip_prefix(char):
+                    chunk = chunk[i:]
+                    break
+            else:
+                return items
+
+        offset = len(self.text)
+        self.text += chunk
+        for position in range(offset, len(self.text)):
+            item = self._scan(self.text[position], position)
+            if item is not None:
+                items.append(item)
+            if self.done:
+                # Anything after the object is a closing fence or chatter
+                break
+        return items
+
+    # Allow whitespace and a ```json fence before the object, nothing else
+    def _skip_prefix(self, char):
+        if char == "{" and not self._prefix.strip():
+            self.started = True
+            return True
+        self._prefix += char
+        stripped = self._prefix.lstrip()
+        if stripped.startswith("```"):
+            if "\n" in stripped:
+                fence = stripped.partition("\n")[0]
+                if fence.strip("` ") not in ("", "json"):
+                    raise JSONStreamError(f"Unexpected code fence: {fence!r}")
+                self._prefix = ""
+            elif len(stripped) > 10:
+                raise JSONStreamError(f"Unexpected output before JSON: {stripped!r}")
+        elif stripped and not "```".startswith(stripped):
+            raise JSONStreamError(f"Unexpected output before JSON: {stripped[:40]!r}")
+        return False
+
+    def _scan(self, char, position):
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if not self._after_colon:
+                    self._last_string = _loads(self.text[self._string_start : position + 1])
+            return None
+
+        if char == '"':
+            self._in_string = True
+            self._string_start = position
+        elif char in CLOSERS:
+            key = self._last_string if self._after_colon else None
+            self._after_colon = False
+            self._stack.append((char, key, position))
+            if char == "[" or len(self._stack) == 1:
+                self._mark_safe(position + 1)
+        elif char in "}]":
+            if not self._stack or CLOSERS[self._stack[-1][0]] != char:
+                raise JSONStreamError(f"Mismatched {char!r} at offset {position}")
+            opener, _, start = self._stack.pop()
+            self._after_colon = False
+            self._mark_safe(position + 1)
+            if not self._stack:
+                self.done = True
+            elif opener == "{" and self._in_item_list():
+                return _loads(self.text[start : position + 1])
+        elif char == ":":
+            self._after_colon = True
+        elif char == ",":
+            self._after_colon = False
+            self._mark_safe(position)
+        return None
+
+    def _in_item_list(self):
+        return len(self._stack) == 2 and self._stack[1][0] == "[" and self._stack[1][1] == self.item_key
+
+    def _mark_safe(self, end):
+        # Never cut inside a line item; a half-decoded item is worse than none
+        if len(self._stack) > 2 and self._stack[1][1] == self.item_key:
+            return
+        self._safe_end = end
+        self._safe_closers = "".join(CLOSERS[opener] for opener, _, _ in reversed(self._stack))
+
+    # The whole object, or for a stream cut short, everything up to the last
+    # complete value with the open containers closed
+    def result(self):
+        if not self.started:
+            raise JSONStreamError("No JSON object in output")
+        if self.done:
+            return _loads(self.text[: self._safe_end])
+        return _loads(self.text[: self._safe_end] + self._safe_closers)
+
+    @property
+    def truncated(self):
+        return self.started and not self.done
@@ -1,110 +1,778 @@
+import asyncio
 import base64
+import contextvars
+import hashlib
 import io
 import json
 import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import partial
 
-import yaml
 from dotenv import load_dotenv
-from openai import OpenAI
-from pdf2image import convert_from_bytes
-from PIL import Image
 
+from json_stream import IncrementalJSONParser, JSONStreamError
+from llm_clients import LLM_TIMEOUT, get_async_client, get_client
+from metrics import metrics
+from model_router import model_tiers, record_receipt, record_reread, route, route_async
+from money import amounts_match, format_money, normalize_currency, parse_money
+from prompt_store import prompt_store
+from rate_limiter import estimate_request_tokens, rate_limiter
+from result_cache import CACHE_DIR, ResultCache, make_cache_key
+
+# PyMuPDF and Pillow are imported inside the functions that need them, so
+# callers that never see a file do not pay for them.
 
 load_dotenv()  # ✅ Load environment variables
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Models used when a prompt has no `routing:` entry in the prompts file
+VISION_MODEL = "gpt-4-turbo"
+COMBINED_INPUT_MODEL = "gpt-4-turbo"
+# Stream JSON completions so line items arrive early and bad output is cut off
+LLM_STREAMING = os.getenv("LLM_STREAMING", "1") == "1"
+
+# The vision model fits images into 2048x2048 and then scales the short side
+# down to 768px, so anything larger is just payload.
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2048"))
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "768"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "85"))
+IMAGE_PREP_WORKERS = int(os.getenv("IMAGE_PREP_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+# Pages sent together in one vision request; batches run concurrently
+VISION_PAGES_PER_REQUEST = int(os.getenv("VISION_PAGES_PER_REQUEST", "2"))
+VISION_MAX_PAGES = int(os.getenv("VISION_MAX_PAGES", "40"))
+VISION_MAX_TOKENS_PER_PAGE = 1000
+# Seconds for all model calls on one receipt, the amount re-read included; each
+# page batch also stops at LLM_TIMEOUT
+EXTRACTION_TIMEOUT = float(os.getenv("EXTRACTION_TIMEOUT", str(3 * LLM_TIMEOUT)))
+
+vision_cache = ResultCache(os.path.join(CACHE_DIR, "vision"))
+
+
+def build_combined_input_prompt(input_text):
+    return prompt_store.get("extract_text_from_combined_input").render(input_text=input_text)
+
+
+def parse_combined_input_response(raw):
+    raw = raw.strip()
+    if not raw.startswith("{"):
+        raise ValueError("LLM returned invalid or empty JSON")
+    return json.loads(raw)
+
+
+# Dollar amounts the way people type them: $136.42, $ 1,200, US$99, 136.42 USD,
+# USD 136.42, 40 dollars. The number must end at whitespace, punctuation or the
+# end of the text, so "$5k" or "$1.5K" never reads as $5 or $1.50.
+LOCAL_AMOUNT_PATTERN = re.compile(
+    r"""
+    (?:(?P<prefix>US\$|\$|USD)\s*)?
+    (?P<number>\d{1,3}(?:,\d{3})+(?:\.\d{1,2})?|\d+(?:\.\d{1,2})?)
+    (?!\d|[.,]\d)
+    (?=$|[\s.,;:!?)\-–—])
+    (?:\s*(?P<suffix>USD|dollars?|bucks)\b)?
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+# "$2 million", "$3 k": the amount is scaled, which is the LLM's job
+LOCAL_MAGNITUDE = re.compile(
+    r"\s*(?:k|m|mm|mn|b|bn|thousand|million|billion|grand)\b", re.IGNORECASE
+)
+LOCAL_OTHER_CURRENCY = re.compile(r"[€£¥₹]|\b(?:EUR|GBP|JPY|INR|CAD|AUD)\b", re.IGNORECASE)
+LOCAL_REASON_PREFIX = re.compile(r"^(?:[-–—:,;]|\s|for\b|re\b|on\b)+", re.IGNORECASE)
+
+
+# Deterministic split of "amount and reason" input with the amount at either
+# end. Returns None whenever the input is ambiguous (several amounts, other
+# currencies, text on both sides, no reason) so the caller falls back to the LLM.
+def parse_combined_input_locally(input_text):
+    text = input_text.strip()
+    if not text or LOCAL_OTHER_CURRENCY.search(text):
+        return None
+    candidates = list(LOCAL_AMOUNT_PATTERN.finditer(text))
+    marked = [m for m in candidates if m.group("prefix") or m.group("suffix")]
+    if len(marked) == 1:
+        match = marked[0]
+    elif not marked and len(candidates) == 1 and candidates[0].start() == 0:
+        # A bare number only counts when it leads, never "Llama 3.1"
+        match = candidates[0]
+    else:
+        return None
+    if LOCAL_MAGNITUDE.match(text, match.end()):
+        return None
+    # "-$50 refund", "+$5": a signed amount is the LLM's to interpret
+    if text[match.start() - 1 : match.start()] in ("-", "−", "–", "+"):
+        return None
 
+    before = text[: match.start()].strip(" .-–—:,;")
+    after = LOCAL_REASON_PREFIX.sub("", text[match.end() :]).strip(" .-–—:,;")
+    if before and after:
+        return None
+    reason = before or after
+    if not reason:
+        return None
+    number = match.group("number").replace(",", "")
+    return {"amount": f"${float(number):.2f}", "reason": reason}
 
-def load_prompts(path="config/prompts.yaml"):
-    with open(path, "r") as f:
-        return yaml.safe_load(f)
 
+# Times the request itself for llm_call, not the rate limiter's queueing or
+# backoff (rate_limit_wait covers those); only the last attempt is kept
+class RequestTimer:
+    def __init__(self):
+        self.seconds = 0.0
 
-prompts = load_prompts()
+    def wrap(self, create):
+        def timed(**kwargs):
+            start = time.perf_counter()
+            try:
+                return create(**kwargs)
+            finally:
+                self.seconds = time.perf_counter() - start
+
+        return timed
+
+    def wrap_async(self, create):
+        async def timed(**kwargs):
+            start = time.perf_counter()
+            try:
+                return await create(**kwargs)
+            finally:
+                self.seconds = time.perf_counter() - start
+
+        return timed
 
 
 def extract_text_from_combined_input(input_text):
-    prompt = [
-        {"role": p["role"], "content": p["content"].format(input_text=input_text)}
-        for p in prompts["extract_text_from_combined_input"]
-    ]
+    local = parse_combined_input_locally(input_text)
+    if local is not None:
+        print("[Amount Parser] local fast path")
+        return {**local, "source": "local"}
+
+    def call(model):
+        timer = RequestTimer()
+        response = rate_limiter.call(
+            timer.wrap(get_client().chat.completions.with_raw_response.create),
+            model=model,
+            messages=build_combined_input_prompt(input_text),
+            max_tokens=100,
+        )
+        metrics.observe("llm_call", timer.seconds)
+        return parse_combined_input_response(response.choices[0].message.content)
+
+    print("[Amount Parser] LLM fallback")
+    return {**route("extract_text_from_combined_input", COMBINED_INPUT_MODEL, call), "source": "llm"}
+
+
+async def extract_text_from_combined_input_async(input_text, timeout=LLM_TIMEOUT):
+    # One deadline for every routing tier
+    deadline = time.monotonic() + timeout
+    local = parse_combined_input_locally(input_text)
+    if local is not None:
+        print("[Amount Parser] local fast path")
+        return {**local, "source": "local"}
+
+    async def call(model):
+        timer = RequestTimer()
+        response = await rate_limiter.acall(
+            timer.wrap_async(get_async_client().chat.completions.with_raw_response.create),
+            deadline=deadline,
+            model=model,
+            messages=build_combined_input_prompt(input_text),
+            max_tokens=100,
+        )
+        metrics.observe("llm_call", timer.seconds)
+        return parse_combined_input_response(response.choices[0].message.content)
+
+    print("[Amount Parser] LLM fallback")
+    extracted = await route_async("extract_text_from_combined_input", COMBINED_INPUT_MODEL, call)
+    return {**extracted, "source": "llm"}
+
+
+def fit_to_budget(width, height, max_side=IMAGE_MAX_SIDE, min_side=IMAGE_MIN_SIDE):
+    scale = min(max_side / max(width, height), min_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def encode_image(image, image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY):
+    from PIL import Image
+
+    if image_format not in IMAGE_MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    if image_format != "PNG" and image.mode != "RGB":
+        background = Image.new("RGB", image.size, "white")
+        rgba = image.convert("RGBA")
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        image = background
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format, quality=quality)
+    encoded = base64.b64encode(buffered.getvalue()).decode()
+    return f"data:{IMAGE_MIME_TYPES[image_format]};base64,{encoded}"
 
-    response = client.chat.completions.create(
-        model="gpt-4-turbo", messages=prompt, max_tokens=100
+
+# Render only the requested PDF pages, straight at the size the model will use
+def render_pdf_pages(file_bytes, pages=(0,), max_side=IMAGE_MAX_SIDE, min_side=IMAGE_MIN_SIDE):
+    import fitz  # PyMuPDF
+    from PIL import Image
+
+    images = []
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        for page_num in pages:
+            if page_num >= len(doc):
+                break
+            page = doc.load_page(page_num)
+            width, _ = fit_to_budget(page.rect.width, page.rect.height, max_side, min_side)
+            zoom = width / page.rect.width
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            images.append(Image.frombytes("RGB", (pix.width, pix.height), pix.samples))
+    return images
+
+
+def load_image(file_bytes, max_side=IMAGE_MAX_SIDE, min_side=IMAGE_MIN_SIDE):
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(file_bytes))
+    size = fit_to_budget(image.width, image.height, max_side, min_side)
+    if size[0] < image.width:
+        image.draft("RGB", size)
+        image = image.resize(size, Image.LANCZOS)
+    return image
+
+
+def prepare_image_data_urls(
+    file_bytes,
+    file_name,
+    pages=(0,),
+    image_format=IMAGE_FORMAT,
+    quality=IMAGE_QUALITY,
+    max_side=IMAGE_MAX_SIDE,
+    min_side=IMAGE_MIN_SIDE,
+):
+    with metrics.time("rasterize"):
+        if file_name.lower().endswith(".pdf"):
+            images = render_pdf_pages(file_bytes, pages, max_side, min_side)
+        else:
+            images = [load_image(file_bytes, max_side, min_side)]
+        return [encode_image(image, image_format, quality) for image in images]
+
+
+def prepare_image_data_url(file_bytes, file_name, **options):
+    return prepare_image_data_urls(file_bytes, file_name, pages=(0,), **options)[0]
+
+
+def page_count(file_bytes, file_name):
+    if not file_name.lower().endswith(".pdf"):
+        return 1
+    import fitz
+
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        return len(doc)
+
+
+def page_batches(count, size=VISION_PAGES_PER_REQUEST):
+    size = max(1, size)
+    return [tuple(range(start, min(start + size, count))) for start in range(0, count, size)]
+
+
+_PDF_REFERENCE = re.compile(r"(\d+) \d+ R")
+# Back-references to the page tree, and the keys that change when streams are
+# recompressed (the decoded data is what gets hashed)
+_PDF_IGNORED_KEYS = re.compile(
+    r"/(?:Parent|Length)\s*(?:\d+ \d+ R|\d+)|/Filter\s*(?:/FlateDecode|\[\s*/FlateDecode\s*\])"
+)
+
+
+# Every object a page can reach (content streams, resources, Form XObjects,
+# fonts, images), depth first. Object numbers are replaced by visit order so
+# a renumbered re-export hashes the same; the trailer /ID and document
+# metadata are never reached from a page.
+def _hash_pdf_page(doc, page_xref, digest):
+    order = {}
+    pending = [page_xref]
+    while pending:
+        xref = pending.pop()
+        if xref in order:
+            continue
+        order[xref] = len(order)
+        source = _PDF_IGNORED_KEYS.sub("", doc.xref_object(xref, compressed=True))
+        references = [int(ref) for ref in _PDF_REFERENCE.findall(source)]
+        pending.extend(reversed(references))
+        digest.update(
+            _PDF_REFERENCE.sub(
+                lambda m: f"@{references.index(int(m.group(1)))}", source
+            ).encode()
+        )
+        if doc.xref_is_stream(xref):
+            digest.update(doc.xref_stream(xref) or b"")
+        digest.update(b"\0")
+
+
+# Hash what the invoice looks like rather than the raw upload, so a re-exported
+# PDF with a new /ID or timestamp still maps to the same cache entry. Anything
+# that cannot be walked falls back to the exact bytes.
+def fingerprint_file(file_bytes, file_name):
+    digest = hashlib.sha256()
+    if file_name.lower().endswith(".pdf"):
+        import fitz
+
+        try:
+            with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+                for page in doc:
+                    _hash_pdf_page(doc, page.xref, digest)
+            return digest.hexdigest()
+        except Exception:
+            digest = hashlib.sha256()
+    digest.update(file_bytes)
+    return digest.hexdigest()
+
+
+def vision_cache_key(file_bytes, file_name, models):
+    return make_cache_key(
+        fingerprint_file(file_bytes, file_name),
+        "parse_receipt_with_vision",
+        prompt_store.current_version(),
+        ",".join(models),
+        str(VISION_PAGES_PER_REQUEST),
+        str(VISION_MAX_PAGES),
     )
 
-    raw = response.choices[0].message.content.strip()
 
-    if not raw.startswith("{"):
-        raise ValueError("LLM returned invalid or empty JSON")
+_image_pool = None
+
+
+def get_image_pool():
+    global _image_pool
+    if _image_pool is None:
+        _image_pool = ThreadPoolExecutor(
+            max_workers=IMAGE_PREP_WORKERS, thread_name_prefix="image-prep"
+        )
+    return _image_pool
 
-    return json.loads(raw)
 
+# run_in_executor does not carry context over, so metrics scopes are copied in
+async def run_in_image_pool(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_image_pool(), partial(context.run, func, *args, **kwargs))
 
-def prepare_image_data_url(file_bytes, file_name):
-    image = (
-        convert_from_bytes(file_bytes)[0]
-        if file_name.lower().endswith(".pdf")
-        else Image.open(io.BytesIO(file_bytes))
+
+async def prepare_image_data_url_async(file_bytes, file_name, **options):
+    return await run_in_image_pool(prepare_image_data_url, file_bytes, file_name, **options)
+
+
+async def prepare_image_data_urls_async(file_bytes, file_name, pages=(0,), **options):
+    return await run_in_image_pool(
+        prepare_image_data_urls, file_bytes, file_name, pages=pages, **options
     )
-    buffered = io.BytesIO()
-    image.save(buffered, format="PNG")
-    return f"data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode()}"
-
-
-def parse_receipt_with_vision(amount, reason, data_url):
-    vision_prompt = [
-        {
-            "role": prompts["parse_receipt_with_vision"][0]["role"],
-            "content": prompts["parse_receipt_with_vision"][0]["content"],
-        },
-        {
-            "role": prompts["parse_receipt_with_vision"][1]["role"],
-            "content": [
-                {
-                    "type": "text",
-                    "text": prompts["parse_receipt_with_vision"][1]["content"][0][
-                        "text"
-                    ].format(amount=amount, reason=reason),
-                },
-                {"type": "image_url", "image_url": {"url": data_url}},
-            ],
-        },
-    ]
-
-    vision_resp = client.chat.completions.create(
-        model="gpt-4-turbo", messages=vision_prompt, max_tokens=1000
+
+
+# `data_urls` is one data URL or a list of pages from the same document
+def build_vision_prompt(amount, reason, data_urls):
+    if isinstance(data_urls, str):
+        data_urls = [data_urls]
+    return prompt_store.get("parse_receipt_with_vision").render(
+        images=data_urls, amount=amount, reason=reason
     )
-    result = vision_resp.choices[0].message.content.strip()
-    if result.startswith("```"):
-        result = result.strip("` \n")
-        if result.startswith("json"):
-            result = result[len("json") :].strip()
-    return json.loads(result)
 
 
-def extract_llm_amount_and_items(extracted_json):
-    llm_terms = [
-        "meta llama",
-        "llama",
-    ]
-
-    raw_items = extracted_json.get("line_items", [])
-    llm_items = [
-        item
-        for item in raw_items
-        if any(term in item.get("description", "").lower() for term in llm_terms)
-        or any(term in extracted_json.get("provider", "").lower() for term in llm_terms)
-        or any(term in extracted_json.get("model_version_range", "").lower() for term in llm_terms)
-        or any(term in extracted_json.get("model", "").lower() for term in llm_terms)
-        or any(term in extracted_json.get("llm_model", "").lower() for term in llm_terms)
-    ]
-
-    llm_total = 0.0
-    for item in llm_items:
+def vision_max_tokens(data_urls):
+    pages = 1 if isinstance(data_urls, str) else len(data_urls)
+    return min(4096, VISION_MAX_TOKENS_PER_PAGE * pages)
+
+
+# An object that stops part way is closed off at its last complete value only
+# when the model ran out of tokens; stopping early for any other reason means
+# the output is malformed
+def _complete_result(parser, finish_reason):
+    if parser.truncated:
+        if finish_reason != "length":
+            raise JSONStreamError(f"Output ended inside the object (finish_reason={finish_reason})")
+        print(f"[LLM Stream] Output cut off after {len(parser.text)} chars, keeping complete fields")
+    return parser.result()
+
+
+def parse_json_response(result, finish_reason="stop"):
+    with metrics.time("parse"):
+        parser = IncrementalJSONParser()
+        parser.feed(result)
+        return _complete_result(parser, finish_reason)
+
+
+def _record_stream_usage(parser, model, usage, messages, max_tokens):
+    reserved = estimate_request_tokens(messages, max_tokens)
+    if usage is not None:
+        rate_limiter.settle(reserved, usage.total_tokens)
+        metrics.record_usage(model, usage.prompt_tokens, usage.completion_tokens)
+    elif model:
+        # The stream stopped before its usage chunk (malformed output, a
+        # timeout, a dropped connection); estimate from what was read
+        prompt_tokens, completion_tokens = estimate_request_tokens(messages), len(parser.text) // 4
+        rate_limiter.settle(reserved, prompt_tokens + completion_tokens)
+        metrics.record_usage(model, prompt_tokens, completion_tokens, estimated=True)
+
+
+def _stream_result(parser, parse_seconds, finish_reason):
+    metrics.observe("parse", parse_seconds)
+    return _complete_result(parser, finish_reason)
+
+
+def read_json_stream(stream, messages, max_tokens, on_item=None, item_key="line_items"):
+    parser = IncrementalJSONParser(item_key)
+    model, usage, parse_seconds, finish_reason = None, None, 0.0, None
+    try:
+        for chunk in stream:
+            model = chunk.model or model
+            usage = chunk.usage or usage
+            if chunk.choices:
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if not chunk.choices or parser.done:
+                # Anything after the object (a closing fence, the usage chunk)
+                # is read to the end so usage arrives and the connection is reused
+                continue
+            start = time.perf_counter()
+            items = parser.feed(chunk.choices[0].delta.content or "")
+            parse_seconds += time.perf_counter() - start
+            for item in items:
+                if on_item is not None:
+                    on_item(item)
+    finally:
+        stream.close()
+        # Also when reading fails part way, so every request is counted
+        _record_stream_usage(parser, model, usage, messages, max_tokens)
+    return _stream_result(parser, parse_seconds, finish_reason)
+
+
+async def read_json_stream_async(stream, messages, max_tokens, on_item=None, item_key="line_items"):
+    parser = IncrementalJSONParser(item_key)
+    model, usage, parse_seconds, finish_reason = None, None, 0.0, None
+    try:
+        async for chunk in stream:
+            model = chunk.model or model
+            usage = chunk.usage or usage
+            if chunk.choices:
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if not chunk.choices or parser.done:
+                continue
+            start = time.perf_counter()
+            items = parser.feed(chunk.choices[0].delta.content or "")
+            parse_seconds += time.perf_counter() - start
+            for item in items:
+                if on_item is not None:
+                    on_item(item)
+    finally:
+        await stream.close()
+        _record_stream_usage(parser, model, usage, messages, max_tokens)
+    return _stream_result(parser, parse_seconds, finish_reason)
+
+
+# One JSON object from a chat completion. Output that is not JSON, or that ends
+# before the object does, is dropped and requested once more; output that runs
+# out of tokens is closed off at the last complete value instead of retried.
+# `on_item` only sees the first attempt's items, so a retry does not show them
+# twice.
+# llm_call covers the request and reading its stream, parse included, but not
+# waiting in the rate limiter.
+def complete_json(create, messages, max_tokens, on_item=None, **kwargs):
+    for attempt in range(2):
+        timer = RequestTimer()
         try:
-            llm_total += float(item["amount"].replace("$", "").replace(",", ""))
-        except:
-            continue
+            if not LLM_STREAMING:
+                response = rate_limiter.call(
+                    timer.wrap(create), messages=messages, max_tokens=max_tokens, **kwargs
+                )
+                metrics.observe("llm_call", timer.seconds)
+                choice = response.choices[0]
+                return parse_json_response(choice.message.content or "", choice.finish_reason)
+            stream = rate_limiter.call(
+                timer.wrap(create),
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs,
+            )
+            start = time.perf_counter()
+            try:
+                return read_json_stream(
+                    stream, messages, max_tokens, on_item if not attempt else None
+                )
+            finally:
+                metrics.observe("llm_call", timer.seconds + time.perf_counter() - start)
+        except JSONStreamError as e:
+            metrics.inc("llm_malformed_outputs_total")
+            if attempt:
+                raise
+            print(f"[LLM Stream] Discarding malformed output ({e}), retrying once")
+
+
+# `deadline` (a time.monotonic() value) bounds both attempts, reading the
+# streams included
+async def complete_json_async(create, messages, max_tokens, on_item=None, deadline=None, **kwargs):
+    for attempt in range(2):
+        timer = RequestTimer()
+        try:
+            if not LLM_STREAMING:
+                response = await rate_limiter.acall(
+                    timer.wrap_async(create),
+                    deadline=deadline,
+                    messages=messages,
+                    max_tokens=max_tokens,
+                    **kwargs,
+                )
+                metrics.observe("llm_call", timer.seconds)
+                choice = response.choices[0]
+                return parse_json_response(choice.message.content or "", choice.finish_reason)
+            stream = await rate_limiter.acall(
+                timer.wrap_async(create),
+                deadline=deadline,
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True},
+                **kwargs,
+            )
+            start = time.perf_counter()
+            try:
+                async with asyncio.timeout(
+                    None if deadline is None else deadline - time.monotonic()
+                ):
+                    return await read_json_stream_async(
+                        stream, messages, max_tokens, on_item if not attempt else None
+                    )
+            finally:
+                metrics.observe("llm_call", timer.seconds + time.perf_counter() - start)
+        except JSONStreamError as e:
+            metrics.inc("llm_malformed_outputs_total")
+            if attempt:
+                raise
+            print(f"[LLM Stream] Discarding malformed output ({e}), retrying once")
+
+
+# Like complete_json, only the first routing tier reports line items
+def parse_receipt_with_vision(amount, reason, data_url, on_item=None, models=None):
+    messages = build_vision_prompt(amount, reason, data_url)
+    tiers = models or model_tiers("parse_receipt_with_vision", VISION_MODEL)
+    return route(
+        "parse_receipt_with_vision",
+        VISION_MODEL,
+        lambda model: complete_json(
+            get_client().chat.completions.with_raw_response.create,
+            messages,
+            vision_max_tokens(data_url),
+            on_item=on_item if model == tiers[0] else None,
+            model=model,
+        ),
+        tiers,
+    )
+
+
+# `timeout` covers the whole read: the malformed-output retry and every routing
+# tier share it. `deadline` can only shorten it.
+async def parse_receipt_with_vision_async(
+    amount, reason, data_url, timeout=LLM_TIMEOUT, on_item=None, models=None, deadline=None
+):
+    limit = time.monotonic() + timeout
+    deadline = limit if deadline is None else min(limit, deadline)
+    messages = build_vision_prompt(amount, reason, data_url)
+    tiers = models or model_tiers("parse_receipt_with_vision", VISION_MODEL)
+    return await route_async(
+        "parse_receipt_with_vision",
+        VISION_MODEL,
+        lambda model: complete_json_async(
+            get_async_client().chat.completions.with_raw_response.create,
+            messages,
+            vision_max_tokens(data_url),
+            on_item=on_item if model == tiers[0] else None,
+            deadline=deadline,
+            model=model,
+        ),
+        tiers,
+    )
+
+
+# Header fields come from the first page that has them, except totals, which
+# invoices print at the end. Line items (and notes on pages that were not
+# read) are concatenated in page order.
+MERGE_LAST_VALUE_FIELDS = {"amount", "tax_amount", "total_amount"}
+MERGE_LIST_FIELDS = ("line_items", "pages_not_read")
+
+
+def merge_receipt_results(results):
+    if len(results) == 1:
+        return results[0]
+    merged = {}
+    lists = {key: [] for key in MERGE_LIST_FIELDS}
+    for result in results:
+        for key, value in result.items():
+            if key in lists:
+                lists[key].extend(value or [])
+            elif value not in ("", None, [], {}) and (
+                key not in merged or key in MERGE_LAST_VALUE_FIELDS
+            ):
+                merged[key] = value
+    merged["line_items"] = lists["line_items"]
+    if lists["pages_not_read"]:
+        merged["pages_not_read"] = lists["pages_not_read"]
+    return merged
+
+
+async def extract_pages_async(
+    file_bytes, file_name, pages, amount, reason, on_item=None, models=None, deadline=None
+):
+    data_urls = await prepare_image_data_urls_async(file_bytes, file_name, pages=pages)
+    return await parse_receipt_with_vision_async(
+        amount, reason, data_urls, on_item=on_item, models=models, deadline=deadline
+    )
+
+
+# Cache lookup, rasterization and vision extraction for one upload. Pages are
+# sent in small batches that rasterize and call the model concurrently, so a
+# long bill takes about as long as its slowest batch. The extraction does not
+# need the user's amount, so this can start as soon as the file arrives; the
+# amount is checked against the result afterwards. `on_item` is called with each
+# line item as it is decoded; cached results do not replay them. `models`
+# overrides the routing tiers, which are part of the cache key. `deadline` (a
+# time.monotonic() value) bounds every batch's model calls.
+async def extract_receipt_async(
+    file_bytes,
+    file_name,
+    amount="unknown",
+    reason="not provided yet",
+    on_item=None,
+    models=None,
+    deadline=None,
+):
+    models = models or model_tiers("parse_receipt_with_vision", VISION_MODEL)
+    cache_key = await asyncio.to_thread(vision_cache_key, file_bytes, file_name, models)
+    cached = await asyncio.to_thread(vision_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    count = await asyncio.to_thread(page_count, file_bytes, file_name)
+    pages_not_read = []
+    if count > VISION_MAX_PAGES:
+        print(f"[Vision] {file_name}: only the first {VISION_MAX_PAGES} of {count} pages are read")
+        pages_not_read.append(
+            f"{file_name}: pages {VISION_MAX_PAGES + 1}-{count} of {count} were not read"
+        )
+        count = VISION_MAX_PAGES
+    results = await asyncio.gather(
+        *(
+            extract_pages_async(
+                file_bytes, file_name, pages, amount, reason, on_item, models, deadline
+            )
+            for pages in page_batches(count)
+        )
+    )
+    extracted = merge_receipt_results(results)
+    if pages_not_read:
+        # Kept with the result (and the stored record) so callers can tell the
+        # user the totals only cover part of the invoice
+        extracted = {**extracted, "pages_not_read": pages_not_read}
+    await asyncio.to_thread(vision_cache.set, cache_key, extracted)
+    return extracted
+
+
+# Problem with an extracted receipt given the amount the user asked for, or
+# None. Runs that do not know the amount yet (speculative ones) always pass.
+def receipt_amount_problem(extracted, amount):
+    _, llm_total = extract_llm_amount_and_items(extracted)
+    if amounts_match(llm_total, amount) is False:
+        return f"Llama total {llm_total} does not match requested {amount}"
+    return None
+
+
+async def _read_receipts(files, amount, reason, on_item, models, deadline):
+    results = await asyncio.gather(
+        *(
+            extract_receipt_async(
+                file_bytes, file_name, amount, reason, on_item, models, deadline
+            )
+            for file_bytes, file_name in files
+        )
+    )
+    return merge_receipt_results(results)
+
+
+# Several attachments are treated as parts of one invoice. When the Llama total
+# disagrees with the requested amount, the receipt is read again by the last
+# routing tier before the mismatch is reported. Both reads share one
+# EXTRACTION_TIMEOUT; a re-read that runs out of it keeps the first answer.
+async def extract_receipts_async(
+    files, amount="unknown", reason="not provided yet", on_item=None, models=None, deadline=None
+):
+    if deadline is None:
+        deadline = time.monotonic() + EXTRACTION_TIMEOUT
+    extracted = await _read_receipts(files, amount, reason, on_item, models, deadline)
+    record_receipt("parse_receipt_with_vision")
+    tiers = models or model_tiers("parse_receipt_with_vision", VISION_MODEL)
+    problem = receipt_amount_problem(extracted, amount)
+    if problem is None or len(tiers) == 1:
+        return extracted
+    record_reread("parse_receipt_with_vision", tiers[0], "amount")
+    print(f"[Router] parse_receipt_with_vision: re-reading with {tiers[-1]} ({problem})")
+    # Line items were already shown once; the second read does not repeat them
+    try:
+        return await _read_receipts(files, amount, reason, None, tiers[-1:], deadline)
+    except TimeoutError:
+        print("[Router] parse_receipt_with_vision: out of time for the re-read, keeping the first")
+        return extracted
+
+
+# Comma-separated, matched case-insensitively anywhere in the text
+LLAMA_TERMS = [
+    term.strip() for term in os.getenv("LLAMA_TERMS", "meta llama,llama").split(",") if term.strip()
+]
+# Invoice-level fields that make every line item a Llama item when they match
+LLAMA_INVOICE_FIELDS = ("provider", "model_version_range", "model", "llm_model")
+
+
+# Picks the Llama line items out of an extracted invoice and totals them. The
+# terms are compiled into one pattern up front; invoice-level fields are checked
+# once per invoice and descriptions once per item.
+class LineItemClassifier:
+    def __init__(self, terms=LLAMA_TERMS, invoice_fields=LLAMA_INVOICE_FIELDS):
+        # Longest first so "meta llama" wins over "llama" in the alternation
+        alternation = "|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True))
+        self.pattern = re.compile(alternation or r"(?!)", re.IGNORECASE)
+        self.invoice_fields = invoice_fields
+
+    def invoice_matches(self, extracted_json):
+        search = self.pattern.search
+        return any(search(str(extracted_json.get(field) or "")) for field in self.invoice_fields)
 
-    return llm_items, f"${llm_total:.2f}"
+    def select(self, extracted_json):
+        items = [item for item in extracted_json.get("line_items") or [] if isinstance(item, dict)]
+        if self.invoice_matches(extracted_json):
+            return items
+        search = self.pattern.search
+        return [item for item in items if search(str(item.get("description") or ""))]
+
+    # Exact Decimal sum in the invoice currency. Amounts that do not parse, or
+    # are in another currency, are left out of the total and reported.
+    def total(self, items, currency=None):
+        currency = normalize_currency(currency)
+        total = Decimal(0)
+        skipped = 0
+        for item in items:
+            parsed = parse_money(item.get("amount"), currency)
+            if parsed is None or parsed[1] != currency:
+                skipped += 1
+                continue
+            total += parsed[0]
+        if skipped:
+            print(f"[Classifier] {skipped} of {len(items)} Llama line items left out of the {currency} total")
+        return total, currency
+
+    def classify(self, extracted_json):
+        items = self.select(extracted_json)
+        total, currency = self.total(items, extracted_json.get("currency"))
+        return items, format_money(total, currency)
+
+
+llama_classifier = LineItemClassifier()
+
+
+def extract_llm_amount_and_items(extracted_json):
+    return llama_classifier.classify(extracted_json)
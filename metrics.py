@@ -0,0 +1,228 @@
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_DUMP_PATH = os.getenv("METRICS_DUMP_PATH", "")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", "60"))
+METRICS_PREFIX = "llama_bot"
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# List prices in dollars per million (prompt, completion) tokens. Dated model
+# names match by prefix, e.g. gpt-4-turbo-2024-04-09.
+MODEL_PRICES = {
+    "gpt-4-turbo": (10.00, 30.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4.1": (2.00, 8.00),
+}
+
+
+def model_price(model):
+    matches = [name for name in MODEL_PRICES if model.startswith(name)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else (0.0, 0.0)
+
+
+# Totals for one unit of work (a submission, a CLI run). Stage seconds are
+# summed, so stages that overlap add up to more than the wall time.
+class Scope:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = defaultdict(float)
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost = 0.0
+        self.retries = 0
+
+    def summary(self):
+        stages = ", ".join(
+            f"{stage} {seconds:.2f}s"
+            for stage, seconds in sorted(self.stages.items(), key=lambda item: -item[1])
+        )
+        return (
+            f"{time.monotonic() - self.started:.2f}s wall ({stages}); "
+            f"{self.prompt_tokens}+{self.completion_tokens} tokens, ${self.cost:.4f}, "
+            f"{self.retries} retries"
+        )
+
+
+_scope = contextvars.ContextVar("metrics_scope", default=None)
+
+
+# Attribute everything recorded in this context (and tasks or to_thread calls
+# started from it) to `scope` as well as the process-wide totals
+@contextlib.contextmanager
+def track(scope):
+    token = _scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _scope.reset(token)
+
+
+class Metrics:
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, stage, seconds):
+        key = ("stage_seconds", (("stage", stage),))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+        scope = _scope.get()
+        if scope is not None:
+            scope.stages[stage] += seconds
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    # `estimated` usage (a stream closed before its usage chunk) is counted
+    # under an estimated="true" label so it is never mistaken for billed usage
+    def record_usage(self, model, prompt_tokens, completion_tokens, estimated=False):
+        prompt_price, completion_price = model_price(model)
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+        labels = {"model": model, "estimated": "true"} if estimated else {"model": model}
+        self.inc("llm_tokens_total", prompt_tokens, kind="prompt", **labels)
+        self.inc("llm_tokens_total", completion_tokens, kind="completion", **labels)
+        self.inc("llm_cost_dollars_total", cost, **labels)
+        scope = _scope.get()
+        if scope is not None:
+            scope.prompt_tokens += prompt_tokens
+            scope.completion_tokens += completion_tokens
+            scope.cost += cost
+
+    def record_retry(self, error):
+        self.inc("llm_retries_total", error=type(error).__name__)
+        scope = _scope.get()
+        if scope is not None:
+            scope.retries += 1
+
+    def render_prometheus(self):
+        def label_text(labels):
+            return ",".join(f'{name}="{value}"' for name, value in labels)
+
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f"{METRICS_PREFIX}_{name}{{{label_text(labels)}}} {value:g}")
+        if histograms:
+            lines.append(f"# TYPE {METRICS_PREFIX}_stage_seconds histogram")
+        for (name, labels), (bucket_counts, total, count) in sorted(histograms.items()):
+            base = label_text(labels)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f'{METRICS_PREFIX}_{name}_bucket{{{base},le="{bound:g}"}} {bucket_count}')
+            lines.append(f'{METRICS_PREFIX}_{name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f"{METRICS_PREFIX}_{name}_sum{{{base}}} {total:.6f}")
+            lines.append(f"{METRICS_PREFIX}_{name}_count{{{base}}} {count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self._lock:
+            counters = defaultdict(list)
+            for (name, labels), value in sorted(self._counters.items()):
+                counters[name].append({**dict(labels), "value": value})
+            stages = {
+                dict(labels)["stage"]: {
+                    "count": count,
+                    "sum_seconds": round(total, 6),
+                    "buckets": dict(zip(map(str, self.buckets), bucket_counts)),
+                }
+                for (_, labels), (bucket_counts, total, count) in sorted(self._histograms.items())
+            }
+        return {"generated_at": time.strftime("%Y-%m-%d %H:%M:%S"), "stages": stages, "counters": counters}
+
+    def dump_json(self, path):
+        # Imported here because result_cache reports its hits and misses to us
+        from result_cache import atomic_write_json
+
+        atomic_write_json(path, self.snapshot(), indent=2)
+
+
+# Shared by every module in the process
+metrics = Metrics()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = metrics.render_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(metrics.snapshot(), indent=2), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve_metrics(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 Metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+def dump_periodically(path, interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                metrics.dump_json(path)
+            except OSError as e:
+                print(f"[Metrics] Could not write {path}: {e}")
+
+    threading.Thread(target=run, name="metrics-dump", daemon=True).start()
+
+
+# METRICS_PORT serves /metrics (Prometheus) and /metrics.json;
+# METRICS_DUMP_PATH gets a JSON snapshot every METRICS_DUMP_INTERVAL seconds
+def start_metrics_from_env():
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+    if METRICS_DUMP_PATH:
+        dump_periodically(METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL)
+
+
+def dump_metrics_from_env():
+    if METRICS_DUMP_PATH:
+        metrics.dump_json(METRICS_DUMP_PATH)
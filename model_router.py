@@ -0,0 +1,120 @@
+import os
+
+from metrics import metrics
+from money import parse_money
+from prompt_store import prompt_store
+
+# 0 sends every request straight to the last (largest) model of its route
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "1") == "1"
+
+
+# Models to try for a prompt, cheapest first, from its `routing:` entry in the
+# prompts file; prompts without one use `default_model` alone
+def model_tiers(prompt_name, default_model):
+    models = prompt_store.get(prompt_name).models or [default_model]
+    return models if MODEL_ROUTING else models[-1:]
+
+
+def _is_empty(value):
+    return value in ("", None, [], {})
+
+
+def _field_problem(value, kind):
+    if kind == "text":
+        return None if isinstance(value, str) and value.strip() else "expected text"
+    if kind == "money":
+        return None if parse_money(value) is not None else f"not an amount: {value!r}"
+    if kind == "object":
+        return None if isinstance(value, dict) else "expected an object"
+    if kind == "line_items":
+        if not isinstance(value, list):
+            return "expected a list of line items"
+        for position, item in enumerate(value):
+            if not isinstance(item, dict):
+                return f"line item {position} is not an object"
+            if not _is_empty(item.get("amount")) and parse_money(item["amount"]) is None:
+                return f"line item {position} amount is not an amount: {item['amount']!r}"
+        return None
+    raise ValueError(f"Unknown schema type {kind!r}")
+
+
+# First way `result` breaks the prompt's schema, or None when it fits
+def schema_problem(result, schema):
+    if not isinstance(result, dict):
+        return "expected a JSON object"
+    for field, kind in schema.items():
+        optional = kind.endswith("?")
+        value = result.get(field)
+        if _is_empty(value):
+            if optional:
+                continue
+            return f"{field} is missing"
+        problem = _field_problem(value, kind.rstrip("?"))
+        if problem:
+            return f"{field}: {problem}"
+    return None
+
+
+# Reads of a whole receipt, counted once however many page batches (and routed
+# requests) they took. A read that fails a check on the whole document (its
+# total against the requested amount) is redone by the last tier; the re-read
+# rate is llm_receipt_rereads_total over llm_receipts_total.
+def record_receipt(prompt_name):
+    metrics.inc("llm_receipts_total", prompt=prompt_name)
+
+
+def record_reread(prompt_name, model, reason):
+    metrics.inc("llm_receipt_rereads_total", prompt=prompt_name, model=model, reason=reason)
+
+
+def _accept(prompt_name, model, result, problem):
+    if problem:
+        print(f"[Router] {prompt_name}: keeping {model} output that still fails validation: {problem}")
+    metrics.inc("llm_routed_requests_total", prompt=prompt_name, model=model)
+    return result
+
+
+def _escalate(prompt_name, model, next_model, reason, problem):
+    metrics.inc("llm_escalations_total", prompt=prompt_name, model=model, reason=reason)
+    print(f"[Router] {prompt_name}: {model} -> {next_model} ({problem})")
+
+
+# Calls `call(model)` with each tier in turn until the result is valid JSON that
+# fits the prompt's schema. `models` overrides the configured tiers.
+# The last tier's answer is returned even if it does not validate; its parse
+# errors propagate. The escalation rate is llm_escalations_total over
+# llm_routed_requests_total, both counted per request.
+def route(prompt_name, default_model, call, models=None):
+    tiers = models or model_tiers(prompt_name, default_model)
+    schema = prompt_store.get(prompt_name).schema
+    for tier, model in enumerate(tiers):
+        last = tier == len(tiers) - 1
+        try:
+            result = call(model)
+        except ValueError as e:
+            if last:
+                raise
+            _escalate(prompt_name, model, tiers[tier + 1], "malformed", e)
+            continue
+        problem = schema_problem(result, schema)
+        if problem is None or last:
+            return _accept(prompt_name, model, result, problem)
+        _escalate(prompt_name, model, tiers[tier + 1], "schema", problem)
+
+
+async def route_async(prompt_name, default_model, call, models=None):
+    tiers = models or model_tiers(prompt_name, default_model)
+    schema = prompt_store.get(prompt_name).schema
+    for tier, model in enumerate(tiers):
+        last = tier == len(tiers) - 1
+        try:
+            result = await call(model)
+        except ValueError as e:
+            if last:
+                raise
+            _escalate(prompt_name, model, tiers[tier + 1], "malformed", e)
+            continue
+        problem = schema_problem(result, schema)
+        if problem is None or last:
+            return _accept(prompt_name, model, result, problem)
+        _escalate(prompt_name, model, tiers[tier + 1], "schema", problem)
@@ -0,0 +1,126 @@
+import re
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+CENT = Decimal("0.01")
+DEFAULT_CURRENCY = "USD"
+
+CURRENCY_SYMBOLS = {"US$": "USD", "$": "USD", "€": "EUR", "£": "GBP", "¥": "JPY", "₹": "INR"}
+
+# "$1,234.56", "USD 12", "12.30 eur", "-$5.00", "€1.234,56", "0.00000003"
+MONEY_PATTERN = re.compile(
+    r"""
+    ^(?P<sign>[-−])?
+    (?:(?P<prefix>US\$|[$€£¥₹]|[A-Z]{3})\s*)?
+    (?P<inner_sign>[-−])?
+    (?P<number>\d[\d,.\s']*\d|\d|[.,]\d+)
+    (?:\s*(?P<suffix>[$€£¥₹]|[A-Z]{3}))?$
+    """,
+    re.IGNORECASE | re.VERBOSE,
+)
+# The common case, "$12.30" or "12.30", skips the general pattern
+PLAIN_DOLLARS = re.compile(r"(-?)\$?(\d+(?:\.\d+)?)")
+THOUSANDS_COMMA = re.compile(r"\d{1,3}(?:,\d{3})+")
+THOUSANDS_DOT = re.compile(r"\d{1,3}(?:\.\d{3}){2,}")
+
+
+def _currency(token):
+    if token is None:
+        return None
+    return CURRENCY_SYMBOLS.get(token.upper(), token.upper())
+
+
+# Normalizes the digit grouping to a plain "1234.56". The right-most of "," and
+# "." is the decimal mark when both appear; a lone "," is a thousands separator
+# only in groups of exactly three digits.
+def _normalize_number(number):
+    number = re.sub(r"[\s']", "", number)
+    if "," in number and "." in number:
+        decimal_mark = "," if number.rfind(",") > number.rfind(".") else "."
+        grouping = "." if decimal_mark == "," else ","
+        whole, _, fraction = number.rpartition(decimal_mark)
+        if decimal_mark in whole:
+            return None
+        return whole.replace(grouping, "") + "." + fraction
+    if "," in number:
+        if THOUSANDS_COMMA.fullmatch(number):
+            return number.replace(",", "")
+        return number.replace(",", ".") if number.count(",") == 1 else None
+    if number.count(".") > 1:
+        return number.replace(".", "") if THOUSANDS_DOT.fullmatch(number) else None
+    return number
+
+
+# (Decimal amount, ISO currency) for a money string or number, or None when it
+# is not one. Amounts are exact; nothing passes through float.
+def parse_money(value, default_currency=DEFAULT_CURRENCY):
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        try:
+            amount = Decimal(str(value))
+        except InvalidOperation:
+            return None
+        return (amount, default_currency) if amount.is_finite() else None
+
+    text = str(value).strip()
+    plain = PLAIN_DOLLARS.fullmatch(text)
+    if plain is not None:
+        currency = "USD" if "$" in text else default_currency
+        return Decimal(plain.group(1) + plain.group(2)), currency
+    negative = text.startswith("(") and text.endswith(")")
+    if negative:
+        text = text[1:-1].strip()
+    match = MONEY_PATTERN.match(text)
+    if match is None:
+        return None
+    prefix, suffix = _currency(match.group("prefix")), _currency(match.group("suffix"))
+    if prefix and suffix and prefix != suffix:
+        return None
+    number = _normalize_number(match.group("number"))
+    if number is None:
+        return None
+    try:
+        amount = Decimal(number)
+    except InvalidOperation:
+        return None
+    signs = [negative, bool(match.group("sign")), bool(match.group("inner_sign"))].count(True)
+    if signs > 1:
+        return None  # "--5", "(-$5)"
+    if signs:
+        amount = -amount
+    return amount, prefix or suffix or default_currency
+
+
+# ISO code for an invoice's "currency" field ("usd", "€"); anything else
+# ("US Dollars") falls back to the default
+def normalize_currency(value, default=DEFAULT_CURRENCY):
+    token = str(value or "").strip().upper()
+    if token in CURRENCY_SYMBOLS:
+        return CURRENCY_SYMBOLS[token]
+    return token if re.fullmatch(r"[A-Z]{3}", token) else default
+
+
+def parse_amount(value, default_currency=DEFAULT_CURRENCY):
+    parsed = parse_money(value, default_currency)
+    return parsed[0] if parsed else None
+
+
+def to_cents(amount):
+    return amount.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+# True when both are the same amount to the cent in the same currency, None
+# when either is not an amount
+def amounts_match(a, b, default_currency=DEFAULT_CURRENCY):
+    a, b = parse_money(a, default_currency), parse_money(b, default_currency)
+    if a is None or b is None:
+        return None
+    return a[1] == b[1] and to_cents(a[0]) == to_cents(b[0])
+
+
+# "$12.30" for dollars, as the rest of the bot writes them; "EUR 12.30" otherwise
+def format_money(amount, currency=DEFAULT_CURRENCY):
+    sign = "-" if amount < 0 else ""
+    if currency == "USD":
+        return f"{sign}${to_cents(abs(amount))}"
+    return f"{sign}{currency} {to_cents(abs(amount))}"
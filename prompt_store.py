@@ -0,0 +1,147 @@
+import os
+import string
+import threading
+import time
+
+PROMPTS_PATH = os.getenv("PROMPTS_PATH", "config/prompts.yaml")
+# How often a lookup may stat the file to pick up edits; 0 disables reloading
+PROMPT_RELOAD_INTERVAL = float(os.getenv("PROMPT_RELOAD_INTERVAL", "2"))
+
+_formatter = string.Formatter()
+
+
+# A str.format template split into literal text and fields once, so rendering
+# is a join. Templates without fields render to the same string every time,
+# and text whose braces are not simple {name} fields (a JSON example in a
+# system prompt) is sent verbatim, as it was before templating.
+class CompiledText:
+    def __init__(self, template):
+        self.template = template
+        self.parts = []
+        try:
+            for literal, field, spec, conversion in _formatter.parse(template):
+                if literal:
+                    self.parts.append(literal)
+                if field is not None:
+                    if not field.isidentifier() or conversion:
+                        raise ValueError(field)
+                    self.parts.append((field, spec or ""))
+        except ValueError:
+            self.parts = [template]
+        self.constant = "".join(self.parts) if all(isinstance(p, str) for p in self.parts) else None
+
+    def render(self, values):
+        if self.constant is not None:
+            return self.constant
+        return "".join(
+            part if isinstance(part, str) else format(values[part[0]], part[1]) for part in self.parts
+        )
+
+
+# One prompt from the YAML: a list of messages whose content is a string or a
+# list of text and image_url parts. Each image_url part stands for the images
+# passed to render(), however many there are. `models` and `schema` come from
+# the prompt's entry under `routing:`, if it has one.
+class PromptTemplate:
+    def __init__(self, name, messages, routing=None):
+        self.name = name
+        routing = routing or {}
+        self.models = list(routing.get("models") or [])
+        self.schema = dict(routing.get("schema") or {})
+        self.messages = []
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                compiled = CompiledText(content)
+            else:
+                compiled = [
+                    CompiledText(part["text"]) if part["type"] == "text" else None for part in content
+                ]
+            self.messages.append((message["role"], compiled))
+
+    # Raw content of a message, e.g. for cache keys and token budgets
+    def text(self, index=0):
+        compiled = self.messages[index][1]
+        if isinstance(compiled, CompiledText):
+            return compiled.template
+        return "\n".join(part.template for part in compiled if part is not None)
+
+    def render(self, images=(), **values):
+        rendered = []
+        for role, compiled in self.messages:
+            if isinstance(compiled, CompiledText):
+                rendered.append({"role": role, "content": compiled.render(values)})
+                continue
+            content = []
+            for part in compiled:
+                if part is None:
+                    content.extend({"type": "image_url", "image_url": {"url": url}} for url in images)
+                else:
+                    content.append({"type": "text", "text": part.render(values)})
+            rendered.append({"role": role, "content": content})
+        return rendered
+
+
+# Prompts parsed and compiled once, then recompiled when the file changes.
+# A broken edit is reported and the previous prompts stay in use.
+class PromptStore:
+    def __init__(self, path=PROMPTS_PATH, reload_interval=PROMPT_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.version = "0"
+        self._templates = None
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        return self._current()[name]
+
+    def current_version(self):
+        self._current()
+        return self.version
+
+    def _current(self):
+        now = time.monotonic()
+        if self._templates is None or (
+            self.reload_interval and now - self._checked > self.reload_interval
+        ):
+            with self._lock:
+                self._checked = now
+                try:
+                    mtime = os.stat(self.path).st_mtime_ns
+                except OSError:
+                    if self._templates is None:
+                        raise
+                    mtime = self._mtime
+                if self._templates is None or mtime != self._mtime:
+                    self._load(mtime)
+        return self._templates
+
+    def _load(self, mtime):
+        import yaml
+
+        try:
+            with open(self.path, "r") as f:
+                raw = yaml.safe_load(f)
+            routing = raw.get("routing") or {}
+            templates = {
+                name: PromptTemplate(name, messages, routing.get(name))
+                for name, messages in raw.items()
+                if name not in ("version", "routing")
+            }
+        except Exception as e:
+            if self._templates is None:
+                raise
+            print(f"[Prompts] Keeping previous prompts, could not reload {self.path}: {e}")
+            self._mtime = mtime
+            return
+        if self._templates is not None:
+            print(f"[Prompts] Reloaded {self.path} (version {raw.get('version', 0)})")
+        self._templates = templates
+        self.version = str(raw.get("version", 0))
+        self._mtime = mtime
+
+
+# Shared by every module in the process
+prompt_store = PromptStore()
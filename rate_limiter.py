@@ -0,0 +1,228 @@
+import asyncio
+import os
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+
+from metrics import metrics
+
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "30000"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "6"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "60"))
+
+# Rough cost of an image whose size we don't know (a full-page high-detail render)
+DEFAULT_IMAGE_TOKENS = 765
+
+
+# openai is imported on first use; by then a client has already loaded it
+@lru_cache(maxsize=None)
+def retryable_errors():
+    import openai
+
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def estimate_request_tokens(messages, max_tokens=0):
+    tokens = max_tokens
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            else:
+                tokens += DEFAULT_IMAGE_TOKENS
+    return tokens
+
+
+# Token bucket that allows going into debt: a caller takes what it needs and
+# waits until the bucket refills past zero, so waiters are served in order.
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+    def sync(self, limit, remaining, now):
+        self._refill(now)
+        if limit:
+            self.capacity = limit
+            self.rate = limit / 60
+        if remaining is not None:
+            # Trust the server when it has seen less headroom than we think
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute=OPENAI_RPM,
+        tokens_per_minute=OPENAI_TPM,
+        max_retries=LLM_MAX_RETRIES,
+        backoff_base=LLM_BACKOFF_BASE,
+        backoff_cap=LLM_BACKOFF_CAP,
+    ):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+
+    def reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+            return max(wait, self._paused_until - now)
+
+    def settle(self, estimated_tokens, used_tokens):
+        # Return (or charge) the difference between the estimate and real usage
+        with self._lock:
+            self.tokens.reserve(used_tokens - estimated_tokens, time.monotonic())
+
+    def update_from_headers(self, headers):
+        def header(name):
+            value = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        with self._lock:
+            now = time.monotonic()
+            self.requests.sync(
+                header("x-ratelimit-limit-requests"),
+                header("x-ratelimit-remaining-requests"),
+                now,
+            )
+            self.tokens.sync(
+                header("x-ratelimit-limit-tokens"),
+                header("x-ratelimit-remaining-tokens"),
+                now,
+            )
+
+    def backoff(self, attempt, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            self.update_from_headers(response.headers)
+            retry_after = parse_duration(response.headers.get("retry-after"))
+            retry_after_ms = parse_duration(response.headers.get("retry-after-ms"))
+            if retry_after_ms:
+                retry_after = retry_after_ms / 1000
+        # Full jitter keeps parallel workers from retrying in lockstep
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2**attempt))
+        if retry_after:
+            delay = max(delay, retry_after)
+            import openai
+
+            if isinstance(error, openai.RateLimitError):
+                # Everyone else is about to hit the same wall; hold them too
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        return delay
+
+    def _record(self, raw, estimated_tokens):
+        self.update_from_headers(raw.headers)
+        response = raw.parse()
+        # Streams report usage in their last chunk; the reader records it
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.settle(estimated_tokens, usage.total_tokens)
+            metrics.record_usage(response.model, usage.prompt_tokens, usage.completion_tokens)
+        return response
+
+    # `create` is a with_raw_response create method so limit headers are visible
+    def call(self, create, **kwargs):
+        estimated = estimate_request_tokens(kwargs["messages"], kwargs.get("max_tokens", 0))
+        for attempt in range(self.max_retries + 1):
+            wait = self.reserve(estimated)
+            metrics.observe("rate_limit_wait", wait)
+            time.sleep(wait)
+            try:
+                raw = create(**kwargs)
+            except retryable_errors() as e:
+                # A failed attempt used no tokens; give its reservation back
+                # so retries do not drain the bucket
+                self.settle(estimated, 0)
+                if attempt == self.max_retries:
+                    raise
+                metrics.record_retry(e)
+                delay = self.backoff(attempt, e)
+                print(f"LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            return self._record(raw, estimated)
+
+    # `timeout` is one deadline for the whole call, counted from the first
+    # request: retries, backoff and later limiter waits all come out of it, and
+    # running out of it is never retried. `deadline` is the same as an absolute
+    # time.monotonic() value that also covers the first limiter wait, for
+    # callers that share one deadline between several calls.
+    async def acall(self, create, timeout=None, deadline=None, **kwargs):
+        estimated = estimate_request_tokens(kwargs["messages"], kwargs.get("max_tokens", 0))
+        for attempt in range(self.max_retries + 1):
+            wait = self.reserve(estimated)
+            if deadline is not None and time.monotonic() + wait >= deadline:
+                self.settle(estimated, 0)
+                raise asyncio.TimeoutError()
+            metrics.observe("rate_limit_wait", wait)
+            await asyncio.sleep(wait)
+            if deadline is None and timeout is not None:
+                deadline = time.monotonic() + timeout
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                raw = await asyncio.wait_for(create(**kwargs), remaining)
+            except retryable_errors() as e:
+                self.settle(estimated, 0)
+                delay = self.backoff(attempt, e)
+                if attempt == self.max_retries or (
+                    deadline is not None and time.monotonic() + delay >= deadline
+                ):
+                    raise
+                metrics.record_retry(e)
+                print(f"LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            return self._record(raw, estimated)
+
+
+# Shared by every OpenAI call in the process
+rate_limiter = RateLimiter()
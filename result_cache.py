@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from metrics import metrics
+
+CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "cache")
+CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+CACHE_MAX_AGE = float(os.getenv("RESULT_CACHE_MAX_AGE_DAYS", "90")) * 86400
+
+
+def make_cache_key(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+# Write to a temp file in the same directory and rename over the target, so
+# readers never see a partial file. Returns the number of bytes written.
+def atomic_write_json(path, value, indent=None):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            if indent is None:
+                json.dump(value, f, separators=(",", ":"))
+            else:
+                json.dump(value, f, indent=indent)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+# JSON results stored one file per key; safe to share between processes
+class ResultCache:
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+        self.directory = directory
+        self.name = os.path.basename(os.path.normpath(directory))
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._approx_bytes = None
+        self._last_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if self.max_age and time.time() - stat.st_mtime > self.max_age:
+                self._remove(path)
+                self._count(misses=1, evictions=1)
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            # Touch on hit so eviction drops the least recently used entries
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._count(misses=1)
+            return None
+        self._count(hits=1)
+        return value
+
+    def set(self, key, value):
+        size = atomic_write_json(self._path(key), value)
+
+        with self._lock:
+            self.writes += 1
+            if self._approx_bytes is not None:
+                self._approx_bytes += size
+            needs_sweep = (
+                self._approx_bytes is None
+                or self._approx_bytes > self.max_bytes
+                or time.time() - self._last_sweep > 3600
+            )
+        if needs_sweep:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if name.endswith(".tmp"):
+                        # Leftovers from a crashed writer
+                        if now - stat.st_mtime > 3600:
+                            self._remove(path)
+                        continue
+                    if self.max_age and now - stat.st_mtime > self.max_age:
+                        self._remove(path)
+                        self.evictions += 1
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                self.evictions += 1
+                total -= size
+
+            self._approx_bytes = total
+            self._last_sweep = now
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
+
+    def _count(self, hits=0, misses=0, evictions=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+        if hits:
+            metrics.inc("cache_requests_total", hits, cache=self.name, result="hit")
+        if misses:
+            metrics.inc("cache_requests_total", misses, cache=self.name, result="miss")
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
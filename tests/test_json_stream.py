@@ -0,0 +1,88 @@
+import pytest
+
+from json_stream import IncrementalJSONParser, JSONStreamError
+
+
+def feed_all(chunks, item_key="line_items"):
+    parser = IncrementalJSONParser(item_key)
+    items = []
+    for chunk in chunks:
+        items.extend(parser.feed(chunk))
+    return parser, items
+
+
+def test_whole_object():
+    parser, items = feed_all(['{"a": 1, "b": [1, 2]}'])
+    assert parser.done and not parser.truncated
+    assert parser.result() == {"a": 1, "b": [1, 2]}
+    assert items == []
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        ['```json\n{"a": 1}\n```'],
+        ["``", '`json\n{"a"', ": 1}", "\n```"],
+        ['```\n{"a": 1}\n```'],
+        ['  \n{"a": 1}'],
+    ],
+)
+def test_fences_and_whitespace_before_the_object(chunks):
+    parser, _ = feed_all(chunks)
+    assert parser.result() == {"a": 1}
+
+
+@pytest.mark.parametrize(
+    "chunks",
+    [
+        ['Here you go: {"a": 1}'],
+        ['```python\n{"a": 1}'],
+        ['{"a": [1}'],
+        ['{"a": 1]'],
+    ],
+)
+def test_malformed_output_fails_early(chunks):
+    with pytest.raises(JSONStreamError):
+        feed_all(chunks)
+
+
+def test_no_object():
+    parser, _ = feed_all(["", "  "])
+    with pytest.raises(JSONStreamError):
+        parser.result()
+
+
+def test_items_are_returned_as_they_close():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"line_items": [{"x": 1}, {"x"') == [{"x": 1}]
+    assert parser.feed(': 2}], "total": 3}') == [{"x": 2}]
+    assert parser.result() == {"line_items": [{"x": 1}, {"x": 2}], "total": 3}
+
+
+def test_only_top_level_item_key_yields_items():
+    _, items = feed_all(['{"nested": {"line_items": [{"x": 1}]}, "other": [{"y": 2}]}'])
+    assert items == []
+
+
+def test_escaped_quotes_and_brackets_in_strings():
+    parser, items = feed_all(['{"line_items": [{"d": "say \\"hi\\" ]}"}], "k": "{["}'])
+    assert items == [{"d": 'say "hi" ]}'}]
+    assert parser.result()["k"] == "{["
+
+
+def test_truncated_stream_keeps_complete_values():
+    parser, items = feed_all(['{"a": "b", "line_items": [{"x": 1}, {"x": 2', ""])
+    assert parser.truncated
+    assert items == [{"x": 1}]
+    assert parser.result() == {"a": "b", "line_items": [{"x": 1}]}
+
+
+def test_truncated_inside_a_string():
+    parser, _ = feed_all(['{"a": "b", "c": "unfinish'])
+    assert parser.result() == {"a": "b"}
+
+
+def test_text_after_the_object_is_ignored():
+    parser, _ = feed_all(['{"a": 1}', "\n```", " and some chatter }"])
+    assert parser.done
+    assert parser.result() == {"a": 1}
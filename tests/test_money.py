@@ -0,0 +1,86 @@
+from decimal import Decimal
+
+import pytest
+
+from money import amounts_match, format_money, normalize_currency, parse_amount, parse_money
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("$1,234.56", (Decimal("1234.56"), "USD")),
+        ("12.30", (Decimal("12.30"), "USD")),
+        ("USD 12", (Decimal("12"), "USD")),
+        ("US$ 7", (Decimal("7"), "USD")),
+        ("12.30 eur", (Decimal("12.30"), "EUR")),
+        ("£3", (Decimal("3"), "GBP")),
+        ("-$5.00", (Decimal("-5.00"), "USD")),
+        ("$-5.00", (Decimal("-5.00"), "USD")),
+        ("($5.00)", (Decimal("-5.00"), "USD")),
+        ("€1.234,56", (Decimal("1234.56"), "EUR")),
+        ("1 234,50 EUR", (Decimal("1234.50"), "EUR")),
+        ("1'234.50", (Decimal("1234.50"), "USD")),
+        ("0.00000003", (Decimal("0.00000003"), "USD")),
+        ("1,234", (Decimal("1234"), "USD")),
+        ("0,5", (Decimal("0.5"), "USD")),
+        ("1.234.567", (Decimal("1234567"), "USD")),
+        (12, (Decimal("12"), "USD")),
+        (1.5, (Decimal("1.5"), "USD")),
+    ],
+)
+def test_parse_money(value, expected):
+    assert parse_money(value) == expected
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "",
+        "$",
+        "N/A",
+        "Llama 3.1",
+        "12 USD $",
+        "12 EUR $",
+        "1,23,4",
+        "1.2.3,4,5",
+        "--5",
+        "(-$5)",
+        "nan",
+        float("inf"),
+        None,
+        True,
+    ],
+)
+def test_parse_money_rejects(value):
+    assert parse_money(value) is None
+
+
+def test_parse_money_default_currency():
+    assert parse_money("12.30", "EUR") == (Decimal("12.30"), "EUR")
+    assert parse_money("$12.30", "EUR") == (Decimal("12.30"), "USD")
+
+
+def test_parse_amount():
+    assert parse_amount("$0.10") + parse_amount("$0.20") == Decimal("0.30")
+    assert parse_amount("N/A") is None
+
+
+def test_normalize_currency():
+    assert normalize_currency("usd") == "USD"
+    assert normalize_currency("€") == "EUR"
+    assert normalize_currency("US Dollars") == "USD"
+    assert normalize_currency(None, "EUR") == "EUR"
+
+
+def test_amounts_match():
+    assert amounts_match("$12.30", "12.3") is True
+    assert amounts_match("12.304", "$12.30") is True
+    assert amounts_match("$12.31", "$12.30") is False
+    assert amounts_match("12 EUR", "$12") is False
+    assert amounts_match("unknown", "$12") is None
+
+
+def test_format_money():
+    assert format_money(Decimal("12.3")) == "$12.30"
+    assert format_money(Decimal("-5")) == "-$5.00"
+    assert format_money(Decimal("1.005"), "EUR") == "EUR 1.01"